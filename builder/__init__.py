@@ -1,10 +1,8 @@
-from .backup import Linux as LinuxBackup
-from .backup import Windows as WindowsBackup
-from .snapshot import Linux as LinuxSnapshot
-from .snapshot import Windows as WindowsSnapshot
-from .virtual_router import VirtualRouter
-from .vm import Linux as LinuxVM
-from .vm import Windows as WindowsVM
+# stdlib
+from importlib import import_module
+from typing import Any
+# lib
+# local
 
 
 __all__ = [
@@ -20,3 +18,28 @@ __all__ = [
     # virtual router
     'VirtualRouter',
 ]
+
+# The builder classes are imported on first access rather than with the package, as between them they pull in
+# paramiko, pywinrm, netaddr and the tracing libraries. Maps each exported name to its (module, class name)
+_BUILDERS = {
+    'LinuxBackup': ('.backup.linux', 'Linux'),
+    'WindowsBackup': ('.backup.windows', 'Windows'),
+    'LinuxSnapshot': ('.snapshot.linux', 'Linux'),
+    'WindowsSnapshot': ('.snapshot.windows', 'Windows'),
+    'LinuxVM': ('.vm.linux', 'Linux'),
+    'WindowsVM': ('.vm.windows', 'Windows'),
+    'VirtualRouter': ('.virtual_router', 'VirtualRouter'),
+}
+
+
+def __getattr__(name: str) -> Any:
+    """
+    Import the requested builder class the first time it is accessed, and cache it on the package
+    """
+    try:
+        module_name, class_name = _BUILDERS[name]
+    except KeyError:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}') from None
+    builder = getattr(import_module(module_name, __name__), class_name)
+    globals()[name] = builder
+    return builder
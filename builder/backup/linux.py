@@ -6,24 +6,25 @@ builder class for kvm backup
 """
 # stdlib
 import logging
-import socket
-from datetime import datetime
-from typing import Any, Dict, Optional
+import re
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Pattern
 # lib
-import opentracing
 from jaeger_client import Span
-from netaddr import IPAddress
-from paramiko import AutoAddPolicy, RSAKey, SSHClient, SSHException
+from paramiko import SSHException
 # local
 import settings
 import utils
 from mixins import LinuxMixin
+from remote_session import RemoteSession
 
 
 __all__ = [
     'Linux',
 ]
 
+utils.preload_templates('backup/kvm/commands/build.j2')
+
 
 class Linux(LinuxMixin):
     """
@@ -31,7 +32,7 @@ class Linux(LinuxMixin):
     When we get to this point, we can be sure that the Backup is on a linux host
     """
     logger = logging.getLogger('robot.builders.backup.linux')
-    template_keys = {
+    template_keys = frozenset({
         # backup location on the Host
         'export_path',
         # the ip address of the host that the Backup will be built in
@@ -40,6 +41,11 @@ class Linux(LinuxMixin):
         'host_sudo_passwd',
         # an identifier that uniquely identifies the vm
         'vm_identifier',
+    })
+    # location of the backups on the host for each of the repositories
+    _REPO_PATHS = {
+        1: settings.KVM_PRIMARY_BACKUP_STORAGE_PATH,
+        2: settings.KVM_SECONDARY_BACKUP_STORAGE_PATH,
     }
 
     @staticmethod
@@ -53,9 +59,8 @@ class Linux(LinuxMixin):
         backup_id = backup_data['id']
 
         # Generate the necessary template data
-        child_span = opentracing.tracer.start_span('generate_template_data', child_of=span)
-        template_data = Linux._get_template_data(backup_data, child_span)
-        child_span.finish()
+        with utils.traced(span, 'generate_template_data') as child_span:
+            template_data = Linux._get_template_data(backup_data, child_span)
 
         # Check that the data was successfully generated
         if template_data is None:
@@ -65,8 +70,8 @@ class Linux(LinuxMixin):
             return False
 
         # Check that all of the necessary keys are present
-        if not all(template_data[key] is not None for key in Linux.template_keys):
-            missing_keys = [f'"{key}"' for key in Linux.template_keys if template_data[key] is None]
+        missing_keys = [f'"{key}"' for key in Linux.template_keys if template_data[key] is None]
+        if missing_keys:
             error_msg = f'Template Data Error, the following keys were missing from the Backup build data: ' \
                         f'{", ".join(missing_keys)}'
             Linux.logger.error(error_msg)
@@ -77,55 +82,50 @@ class Linux(LinuxMixin):
         # If everything is okay, commence building the backup
         host_ip = template_data.pop('host_ip')
 
-        # Generate the command that will be run on the host machine directly
-        child_span = opentracing.tracer.start_span('generate_commands', child_of=span)
-        backup_cmd = Linux._generate_host_commands(backup_id, template_data)
-        child_span.finish()
+        # Generate the commands that will be run on the host machine directly
+        with utils.traced(span, 'generate_commands'):
+            backup_cmds = Linux._generate_host_commands(backup_id, template_data)
 
         # Open a client and run the two necessary commands on the host
         built = False
-        client = SSHClient()
-        client.set_missing_host_key_policy(AutoAddPolicy)
-        key = RSAKey.from_private_key_file('/root/.ssh/id_rsa')
-        sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
         try:
-            # Try connecting to the host and running the necessary commands
-            sock.connect((host_ip, 22))
-            client.connect(
-                hostname=host_ip,
-                username='administrator',
-                pkey=key,
-                timeout=30,
-                sock=sock,
-            )  # No need for password as it should have keys
-            span.set_tag('host', host_ip)
-
-            # Attempt to execute the backup build commands
-            Linux.logger.debug(f'Executing backup build commands for Backup # {backup_id}')
-
-            # time_valid field
-            backup_data['time_valid'] = datetime.utcnow().isoformat().replace('T', ' ').split('.')[0]
-
-            child_span = opentracing.tracer.start_span('build_backup', child_of=span)
-            stdout, stderr = Linux.deploy(backup_cmd, client, child_span)
-            child_span.finish()
+            # Open a session on the host, using a pooled connection, and run the necessary commands
+            with RemoteSession(host_ip, span) as session:
+                # Attempt to execute the backup build commands
+                Linux.logger.debug(f'Executing backup build commands for Backup # {backup_id}')
+
+                # time_valid field
+                backup_data['time_valid'] = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+                with utils.traced(span, 'build_backup') as child_span:
+                    stdout, stderr, built = session.run(
+                        backup_cmds,
+                        child_span,
+                        success_pattern=Linux._done_pattern(template_data['vm_identifier']),
+                    )
 
             if stdout:
                 Linux.logger.debug(f'Backup build command for Backup {backup_id} generated stdout. \n{stdout}')
             if stderr:
                 Linux.logger.error(f'Backup build command for Backup {backup_id} generated stderr. \n{stderr}')
                 backup_data['errors'].append(stderr)
-            built = f'Backup done {template_data["vm_identifier"]}' in stdout
         except (OSError, SSHException, TimeoutError):
             error = f'Exception occured while building Backup #{backup_id} in {host_ip}'
             Linux.logger.error(error, exc_info=True)
             backup_data['errors'].append(error)
             span.set_tag('failed_reason', 'ssh_error')
-        finally:
-            client.close()
 
         return built
 
+    @staticmethod
+    def _done_pattern(vm_identifier: str) -> Pattern[bytes]:
+        """
+        Compile the pattern for the line the build template prints once the backup of the vm is complete
+        :param vm_identifier: The identifier of the vm being backed up
+        :returns: A pattern matching the `---- Backup done <vm_identifier> ----` line
+        """
+        return re.compile(rb'\s*-+ Backup done ' + re.escape(vm_identifier.encode()) + rb' -+')
+
     @staticmethod
     def _get_template_data(backup_data: Dict[str, Any], span: Span) -> Optional[Dict[str, Any]]:
         """
@@ -138,53 +138,52 @@ class Linux(LinuxMixin):
         :returns: The data needed for the template to build a new backup
         """
         backup_id = backup_data['id']
-        vm_id = backup_data['vm']['id']
+        vm = backup_data['vm']
+        vm_id = vm['id']
         backup_identifier = f'{vm_id}_{backup_id}'
 
         Linux.logger.debug(f'Compiling template data for backup #{backup_id}.')
         data: Dict[str, Any] = {key: None for key in Linux.template_keys}
 
         data['host_sudo_passwd'] = settings.NETWORK_PASSWORD
-        data['vm_identifier'] = f'{backup_data["vm"]["project"]["id"]}_{vm_id}'
-        if str(backup_data['repository']) == '1':
-            export_path = f'{settings.KVM_PRIMARY_BACKUP_STORAGE_PATH}{backup_identifier}'
-        elif str(backup_data['repository']) == '2':
-            export_path = f'{settings.KVM_SECONDARY_BACKUP_STORAGE_PATH}{backup_identifier}'
-        else:
+        data['vm_identifier'] = f'{vm["project"]["id"]}_{vm_id}'
+        # The repository may be sent as either an int or a numeric string, normalise it once here
+        try:
+            repository: Optional[int] = int(backup_data['repository'])
+        except (TypeError, ValueError):
+            repository = None
+        base_path = Linux._REPO_PATHS.get(repository)
+        if base_path is None:
             error = f'Repository # {backup_data["repository"]} ' \
-                    f'not available on the server # {backup_data["vm"]["server_id"]}'
+                    f'not available on the server # {vm["server_id"]}'
             Linux.logger.error(error)
             backup_data['errors'].append(error)
             return None
-        data['export_path'] = export_path
+        data['export_path'] = f'{base_path}{backup_identifier}'
 
         # Get the ip address of the host
-        host_ip = None
-        for interface in backup_data['server_data']['interfaces']:
-            if interface['enabled'] is True and interface['ip_address'] is not None:
-                if IPAddress(str(interface['ip_address'])).version == 6:
-                    host_ip = interface['ip_address']
-                    break
-        if host_ip is None:
-            error = f'Host ip address not found for the server # {backup_data["vm"]["server_id"]}'
+        host_interface = utils.find_ipv6_interface(backup_data['server_data']['interfaces'])
+        if host_interface is None:
+            error = f'Host ip address not found for the server # {vm["server_id"]}'
             Linux.logger.error(error)
             backup_data['errors'].append(error)
             return None
-        data['host_ip'] = host_ip
+        data['host_ip'] = host_interface['ip_address']
         return data
 
     @staticmethod
-    def _generate_host_commands(backup_id: int, template_data: Dict[str, Any]) -> str:
+    def _generate_host_commands(backup_id: int, template_data: Dict[str, Any]) -> List[str]:
         """
-        Generate the command that need to be run on the host machine to build the infrastructure
-        Generates the following command:
+        Generate the commands that need to be run on the host machine to build the infrastructure
+        The commands are run in order over the same connection
+        Generates the following commands:
             - command to build the backup
         :param backup_id: The id of the Backup being built. Used for log messages
         :param template_data: The retrieved template data for the Backup
-        :returns: A flag stating whether or not the job was successful
+        :returns: The list of commands to run on the host
         """
         # Render the backup command
         backup_cmd = utils.JINJA_ENV.get_template('backup/kvm/commands/build.j2').render(**template_data)
         Linux.logger.debug(f'Generated backup build command for Backup #{backup_id}\n{backup_cmd}')
 
-        return backup_cmd
+        return [backup_cmd]
@@ -7,12 +7,10 @@ builder class for windows backups
 """
 # stdlib
 import logging
-from datetime import datetime
+from datetime import datetime, timezone
 from typing import Any, Dict, Optional
 # lib
-import opentracing
 from jaeger_client import Span
-from netaddr import IPAddress
 from winrm.exceptions import WinRMError
 # local
 import utils
@@ -24,6 +22,8 @@ __all__ = [
     'Windows',
 ]
 
+utils.preload_templates('backup/hyperv/commands/build.j2')
+
 
 class Windows(WindowsMixin):
     """
@@ -32,13 +32,18 @@ class Windows(WindowsMixin):
     is on a windows host
     """
     logger = logging.getLogger('robot.builders.backup.windows')
-    template_keys = {
+    template_keys = frozenset({
         # backup location on the Host
         'export_path',
         # the DNS hostname for the host machine, as WinRM cannot use IPv6
         'host_name',
         # an identifier that uniquely identifies the vm
         'vm_identifier',
+    })
+    # location of the backups on the host for each of the repositories
+    _REPO_PATHS = {
+        1: settings.HYPERV_PRIMARY_BACKUP_STORAGE_PATH,
+        2: settings.HYPERV_SECONDARY_BACKUP_STORAGE_PATH,
     }
 
     @staticmethod
@@ -52,9 +57,8 @@ class Windows(WindowsMixin):
         backup_id = backup_data['id']
 
         # Generate the necessary template data
-        child_span = opentracing.tracer.start_span('generating_template_data', child_of=span)
-        template_data = Windows._get_template_data(backup_data, child_span)
-        child_span.finish()
+        with utils.traced(span, 'generating_template_data') as child_span:
+            template_data = Windows._get_template_data(backup_data, child_span)
 
         # Check that the data was successfully generated
         if template_data is None:
@@ -65,8 +69,8 @@ class Windows(WindowsMixin):
             return False
 
         # Check that all of the necessary keys are present
-        if not all(template_data[key] is not None for key in Windows.template_keys):
-            missing_keys = [f'"{key}"' for key in Windows.template_keys if template_data[key] is None]
+        missing_keys = [f'"{key}"' for key in Windows.template_keys if template_data[key] is None]
+        if missing_keys:
             error_msg = f'Template Data Error, the following keys were missing from the Backup build data:' \
                         f' {", ".join(missing_keys)}'
             Windows.logger.error(error_msg)
@@ -79,18 +83,16 @@ class Windows(WindowsMixin):
 
         # Render the build command
         # Generate the two commands that will be run on the host machine directly
-        child_span = opentracing.tracer.start_span('generate_commands', child_of=span)
-        backup_build_cmd = Windows._generate_host_commands(backup_id, template_data)
-        child_span.finish()
+        with utils.traced(span, 'generate_commands'):
+            backup_build_cmd = Windows._generate_host_commands(backup_id, template_data)
 
         # Open a client and run the two necessary commands on the host
         built = False
         try:
             # time_valid field
-            backup_data['time_valid'] = datetime.utcnow().isoformat().replace('T', ' ').split('.')[0]
-            child_span = opentracing.tracer.start_span('build_backup', child_of=span)
-            response = Windows.deploy(backup_build_cmd, host_name, child_span)
-            child_span.finish()
+            backup_data['time_valid'] = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+            with utils.traced(span, 'build_backup') as child_span:
+                response = Windows.deploy(backup_build_cmd, host_name, child_span)
             span.set_tag('host', host_name)
         except WinRMError as err:
             error = f'Exception occurred while attempting to build Backup #{backup_id} on {host_name}.'
@@ -124,41 +126,39 @@ class Windows(WindowsMixin):
         :returns: The data needed for the templates to build a Windows Backup
         """
         backup_id = backup_data['id']
-        vm_id = backup_data['vm']['id']
+        vm = backup_data['vm']
+        vm_id = vm['id']
         backup_identifier = f'{vm_id}_{backup_id}'
 
         Windows.logger.debug(f'Compiling template data for Backup #{backup_id}')
         data: Dict[str, Any] = {key: None for key in Windows.template_keys}
 
-        data['vm_identifier'] = f'{backup_data["vm"]["project"]["id"]}_{vm_id}'
+        data['vm_identifier'] = f'{vm["project"]["id"]}_{vm_id}'
         # export path
-        if str(backup_data['repository']) == '1':
-            export_path = f'{settings.HYPERV_PRIMARY_BACKUP_STORAGE_PATH}{backup_identifier}\\'
-        elif str(backup_data['repository']) == '2':
-            export_path = f'{settings.HYPERV_SECONDARY_BACKUP_STORAGE_PATH}{backup_identifier}\\'
-        else:
+        # The repository may be sent as either an int or a numeric string, normalise it once here
+        try:
+            repository: Optional[int] = int(backup_data['repository'])
+        except (TypeError, ValueError):
+            repository = None
+        base_path = Windows._REPO_PATHS.get(repository)
+        if base_path is None:
             error = f'Repository # {backup_data["repository"]} ' \
-                    f'not available on the server # {backup_data["vm"]["server_id"]}'
+                    f'not available on the server # {vm["server_id"]}'
             Windows.logger.error(error)
             backup_data['errors'].append(error)
             return None
-        data['export_path'] = export_path
+        data['export_path'] = f'{base_path}{backup_identifier}\\'
 
         # Get the host name of the server
-        host_name = None
-        for interface in backup_data['server_data']['interfaces']:
-            if interface['enabled'] is True and interface['ip_address'] is not None:
-                if IPAddress(str(interface['ip_address'])).version == 6:
-                    host_name = interface['hostname']
-                    break
-        if host_name is None:
+        host_interface = utils.find_ipv6_interface(backup_data['server_data']['interfaces'])
+        if host_interface is None:
             error = f'Host name is not found for the server # {backup_data["server_id"]}'
             Windows.logger.error(error)
             backup_data['errors'].append(error)
             return None
 
         # Add the host information to the data
-        data['host_name'] = host_name
+        data['host_name'] = host_interface['hostname']
         return data
 
     @staticmethod
@@ -6,23 +6,24 @@ builder class for kvm snapshot
 """
 # stdlib
 import logging
-import socket
-from typing import Any, Dict, Optional
+import re
+from typing import Any, Dict, List, Optional
 # lib
-import opentracing
 from jaeger_client import Span
-from netaddr import IPAddress
-from paramiko import AutoAddPolicy, RSAKey, SSHClient, SSHException
+from paramiko import SSHException
 # local
 import settings
 import utils
 from mixins import LinuxMixin
+from remote_session import RemoteSession
 
 
 __all__ = [
     'Linux',
 ]
 
+utils.preload_templates('snapshot/kvm/commands/build.j2')
+
 
 class Linux(LinuxMixin):
     """
@@ -30,7 +31,7 @@ class Linux(LinuxMixin):
     When we get to this point, we can be sure that the Snapshot is on a linux host
     """
     logger = logging.getLogger('robot.builders.snapshot.linux')
-    template_keys = {
+    template_keys = frozenset({
         # the ip address of the host that the Snapshot will be built in
         'host_ip',
         # the sudo password of the host, used to run some commands
@@ -39,7 +40,9 @@ class Linux(LinuxMixin):
         'snapshot_identifier',
         # an identifier that uniquely identifies the vm
         'vm_identifier',
-    }
+    })
+    # The line virsh prints once the snapshot has been created, ie `Domain snapshot 12_34 created`
+    _CREATED_PATTERN = re.compile(rb'\s*Domain snapshot \S+ created\s*$')
 
     @staticmethod
     def build(snapshot_data: Dict[str, Any], span: Span) -> bool:
@@ -52,9 +55,8 @@ class Linux(LinuxMixin):
         snapshot_id = snapshot_data['id']
 
         # Generate the necessary template data
-        child_span = opentracing.tracer.start_span('generate_template_data', child_of=span)
-        template_data = Linux._get_template_data(snapshot_data, child_span)
-        child_span.finish()
+        with utils.traced(span, 'generate_template_data') as child_span:
+            template_data = Linux._get_template_data(snapshot_data, child_span)
 
         # Check that the data was successfully generated
         if template_data is None:
@@ -64,8 +66,8 @@ class Linux(LinuxMixin):
             return False
 
         # Check that all of the necessary keys are present
-        if not all(template_data[key] is not None for key in Linux.template_keys):
-            missing_keys = [f'"{key}"' for key in Linux.template_keys if template_data[key] is None]
+        missing_keys = [f'"{key}"' for key in Linux.template_keys if template_data[key] is None]
+        if missing_keys:
             error_msg = f'Template Data Error, the following keys were missing from the Snapshot build data: ' \
                         f'{", ".join(missing_keys)}'
             Linux.logger.error(error_msg)
@@ -76,49 +78,35 @@ class Linux(LinuxMixin):
         # If everything is okay, commence building the snapshot
         host_ip = template_data.pop('host_ip')
 
-        # Generate the command that will be run on the host machine directly
-        child_span = opentracing.tracer.start_span('generate_commands', child_of=span)
-        snapshot_cmd = Linux._generate_host_commands(snapshot_id, template_data)
-        child_span.finish()
+        # Generate the commands that will be run on the host machine directly
+        with utils.traced(span, 'generate_commands'):
+            snapshot_cmds = Linux._generate_host_commands(snapshot_id, template_data)
 
         # Open a client and run the two necessary commands on the host
         built = False
-        client = SSHClient()
-        client.set_missing_host_key_policy(AutoAddPolicy)
-        key = RSAKey.from_private_key_file('/root/.ssh/id_rsa')
-        sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
         try:
-            # Try connecting to the host and running the necessary commands
-            sock.connect((host_ip, 22))
-            client.connect(
-                hostname=host_ip,
-                username='administrator',
-                pkey=key,
-                timeout=30,
-                sock=sock,
-            )  # No need for password as it should have keys
-            span.set_tag('host', host_ip)
-
-            # Attempt to execute the snapshot build commands
-            Linux.logger.debug(f'Executing snapshot build commands for Snapshot # {snapshot_id}')
-
-            child_span = opentracing.tracer.start_span('build_snapshot', child_of=span)
-            stdout, stderr = Linux.deploy(snapshot_cmd, client, child_span)
-            child_span.finish()
+            # Open a session on the host, using a pooled connection, and run the necessary commands
+            with RemoteSession(host_ip, span) as session:
+                # Attempt to execute the snapshot build commands
+                Linux.logger.debug(f'Executing snapshot build commands for Snapshot # {snapshot_id}')
+
+                with utils.traced(span, 'build_snapshot') as child_span:
+                    stdout, stderr, built = session.run(
+                        snapshot_cmds,
+                        child_span,
+                        success_pattern=Linux._CREATED_PATTERN,
+                    )
 
             if stdout:
                 Linux.logger.debug(f'Snapshot build command for Snapshot {snapshot_id} generated stdout. \n{stdout}')
             if stderr:
                 Linux.logger.error(f'Snapshot build command for Snapshot {snapshot_id} generated stderr. \n{stderr}')
                 snapshot_data['errors'].append(stderr)
-            built = 'created' in stdout
         except (OSError, SSHException, TimeoutError):
             error = f'Exception occured while building Snapshot #{snapshot_id} in {host_ip}'
             Linux.logger.error(error, exc_info=True)
             snapshot_data['errors'].append(error)
             span.set_tag('failed_reason', 'ssh_error')
-        finally:
-            client.close()
 
         return built
 
@@ -134,40 +122,38 @@ class Linux(LinuxMixin):
         :returns: The data needed for the template to build a new snapshot
         """
         snapshot_id = snapshot_data['id']
+        vm = snapshot_data['vm']
+        vm_id = vm['id']
         Linux.logger.debug(f'Compiling template data for snapshot #{snapshot_id}.')
         data: Dict[str, Any] = {key: None for key in Linux.template_keys}
 
         data['host_sudo_passwd'] = settings.NETWORK_PASSWORD
-        data['snapshot_identifier'] = f'{snapshot_data["vm"]["id"]}_{snapshot_data["id"]}'
-        data['vm_identifier'] = f'{snapshot_data["vm"]["project"]["id"]}_{snapshot_data["vm"]["id"]}'
+        data['snapshot_identifier'] = f'{vm_id}_{snapshot_id}'
+        data['vm_identifier'] = f'{vm["project"]["id"]}_{vm_id}'
 
         # Get the ip address of the host
-        host_ip = None
-        for interface in snapshot_data['server_data']['interfaces']:
-            if interface['enabled'] is True and interface['ip_address'] is not None:
-                if IPAddress(str(interface['ip_address'])).version == 6:
-                    host_ip = interface['ip_address']
-                    break
-        if host_ip is None:
-            error = f'Host ip address not found for the server # {snapshot_data["vm"]["server_id"]}'
+        host_interface = utils.find_ipv6_interface(snapshot_data['server_data']['interfaces'])
+        if host_interface is None:
+            error = f'Host ip address not found for the server # {vm["server_id"]}'
             Linux.logger.error(error)
             snapshot_data['errors'].append(error)
             return None
-        data['host_ip'] = host_ip
+        data['host_ip'] = host_interface['ip_address']
         return data
 
     @staticmethod
-    def _generate_host_commands(snapshot_id: int, template_data: Dict[str, Any]) -> str:
+    def _generate_host_commands(snapshot_id: int, template_data: Dict[str, Any]) -> List[str]:
         """
-        Generate the command that need to be run on the host machine to build the infrastructure
-        Generates the following command:
+        Generate the commands that need to be run on the host machine to build the infrastructure
+        The commands are run in order over the same connection
+        Generates the following commands:
             - command to build the snapshot
         :param snapshot_id: The id of the Snapshot being built. Used for log messages
         :param template_data: The retrieved template data for the Snapshot
-        :returns: A flag stating whether or not the job was successful
+        :returns: The list of commands to run on the host
         """
         # Render the snapshot command
         snapshot_cmd = utils.JINJA_ENV.get_template('snapshot/kvm/commands/build.j2').render(**template_data)
         Linux.logger.debug(f'Generated snapshot build command for Snapshot #{snapshot_id}')
 
-        return snapshot_cmd
+        return [snapshot_cmd]
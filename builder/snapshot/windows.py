@@ -9,9 +9,7 @@ builder class for windows snapshots
 import logging
 from typing import Any, Dict, Optional
 # lib
-import opentracing
 from jaeger_client import Span
-from netaddr import IPAddress
 from winrm.exceptions import WinRMError
 # local
 import utils
@@ -50,9 +48,8 @@ class Windows(WindowsMixin):
         snapshot_id = snapshot_data['id']
 
         # Generate the necessary template data
-        child_span = opentracing.tracer.start_span('generating_template_data', child_of=span)
-        template_data = Windows._get_template_data(snapshot_data, child_span)
-        child_span.finish()
+        with utils.traced(span, 'generating_template_data') as child_span:
+            template_data = Windows._get_template_data(snapshot_data, child_span)
 
         # Check that the data was successfully generated
         if template_data is None:
@@ -76,16 +73,14 @@ class Windows(WindowsMixin):
         host_name = template_data.pop('host_name')
 
         # Render the build command
-        child_span = opentracing.tracer.start_span('generate_command', child_of=span)
-        cmd = utils.JINJA_ENV.get_template('snapshot/hyperv/commands/build.j2').render(**template_data)
-        child_span.finish()
+        with utils.traced(span, 'generate_command'):
+            cmd = utils.JINJA_ENV.get_template('snapshot/hyperv/commands/build.j2').render(**template_data)
 
         # Open a client and run the two necessary commands on the host
         built = False
         try:
-            child_span = opentracing.tracer.start_span('build_snapshot', child_of=span)
-            response = Windows.deploy(cmd, host_name, child_span)
-            child_span.finish()
+            with utils.traced(span, 'build_snapshot') as child_span:
+                response = Windows.deploy(cmd, host_name, child_span)
             span.set_tag('host', host_name)
         except WinRMError as err:
             error = f'Exception occurred while attempting to build Snapshot #{snapshot_id} on {host_name}.'
@@ -126,18 +121,13 @@ class Windows(WindowsMixin):
         data['vm_identifier'] = f'{snapshot_data["vm"]["project"]["id"]}_{snapshot_data["vm"]["id"]}'
 
         # Get the host name of the server
-        host_name = None
-        for interface in snapshot_data['server_data']['interfaces']:
-            if interface['enabled'] is True and interface['ip_address'] is not None:
-                if IPAddress(str(interface['ip_address'])).version == 6:
-                    host_name = interface['hostname']
-                    break
-        if host_name is None:
+        host_interface = utils.find_ipv6_interface(snapshot_data['server_data']['interfaces'])
+        if host_interface is None:
             error = f'Host name is not found for the server # {snapshot_data["server_id"]}'
             Windows.logger.error(error)
             snapshot_data['errors'].append(error)
             return None
 
         # Add the host information to the data
-        data['host_name'] = host_name
+        data['host_name'] = host_interface['hostname']
         return data
@@ -8,18 +8,19 @@ builder class for virtual_routers
 
 # stdlib
 import logging
-import re
-from collections import deque
-import socket
-from typing import Any, Deque, Dict, Optional
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from operator import itemgetter
+from typing import Any, Dict, List, Optional, Set, Tuple
 # lib
 import opentracing
 from cloudcix.api.iaas import IAAS
 from jaeger_client import Span
 from netaddr import IPNetwork
-from paramiko import AutoAddPolicy, RSAKey, SSHClient, SSHException
+from paramiko import SSHException
 # local
 import settings
+import ssh_pool
 import utils
 from mixins import LinuxMixin
 import vpn_mappings
@@ -29,7 +30,27 @@ __all__ = [
     'VirtualRouter',
 ]
 
-ADDRESS_NAME_SUB_PATTERN = re.compile(r'[\.\/:]')
+utils.preload_templates(
+    'virtual_router/commands/build.j2',
+    'virtual_router/features/firewall.j2',
+    'virtual_router/features/floating_bridge.j2',
+    'virtual_router/features/vpn.j2',
+)
+
+# PodNet configuration used by every build, read from settings once on import
+MGMT_IP = settings.MGMT_IP
+PODNET_CPE = settings.PODNET_CPE
+PRIVATE_INF = settings.PRIVATE_INF
+PUBLIC_INF = settings.PUBLIC_INF
+
+
+@lru_cache(maxsize=512)
+def _cidr(address_range: str) -> IPNetwork:
+    """
+    Parse the given address range, caching the result as the same subnets are repeated across rules, routes and builds.
+    The returned network is shared between callers, so it must only be read and never modified
+    """
+    return IPNetwork(address_range)
 
 
 class VirtualRouter(LinuxMixin):
@@ -39,7 +60,7 @@ class VirtualRouter(LinuxMixin):
     # Keep a logger for logging messages from this class
     logger = logging.getLogger('robot.builders.virtual_router')
     # Keep track of the keys necessary for the template, so we can check all keys are present before building
-    template_keys = {
+    template_keys = frozenset({
         # Firewall NFT file name
         'firewall_filename',
         # ID of the IPv4 Floating subnet in the projects network
@@ -80,7 +101,7 @@ class VirtualRouter(LinuxMixin):
         'vpn_filename',
         # The vxLan to use for the project (the project's address id)
         'vxlan',
-    }
+    })
 
     @staticmethod
     def build(virtual_router_data: Dict[str, Any], span: Span) -> bool:
@@ -106,8 +127,8 @@ class VirtualRouter(LinuxMixin):
             return False
 
         # Check that all of the necessary keys are present
-        if not all(template_data[key] is not None for key in VirtualRouter.template_keys):
-            missing_keys = [f'"{key}"' for key in VirtualRouter.template_keys if template_data[key] is None]
+        missing_keys = [f'"{key}"' for key in VirtualRouter.template_keys if template_data[key] is None]
+        if missing_keys:
             error_msg = f'Template Data Error, the following keys were missing from the virtual_router build data:' \
                         f' {", ".join(missing_keys)}'
             VirtualRouter.logger.error(error_msg)
@@ -117,16 +138,21 @@ class VirtualRouter(LinuxMixin):
 
         # If everything is okay, commence building the virtual_router
         child_span = opentracing.tracer.start_span('generate_ip_commands', child_of=span)
-        build_bash_script = utils.JINJA_ENV.get_template('virtual_router/commands/build.j2').render(**template_data)
+        template = utils.JINJA_ENV.get_template('virtual_router/commands/build.j2')
+        build_bash_script = template.render(**template_data)
         VirtualRouter.logger.debug(
             f'Generated build bash script for virtual_router #{virtual_router_id}\n{build_bash_script}',
         )
 
-        firewall_nft = utils.JINJA_ENV.get_template('virtual_router/features/firewall.j2').render(**template_data)
+        # The firewall file is rendered and applied even when the project has no firewall rules of its own, as it also
+        # holds the NAT chains and the namespace's default drop policies
+        template = utils.JINJA_ENV.get_template('virtual_router/features/firewall.j2')
+        firewall_nft = template.render(**template_data)
         VirtualRouter.logger.debug(f'Generated firewall nft for virtual_router #{virtual_router_id}\n{firewall_nft}')
 
         if len(virtual_router_data['vpns']) > 0:
-            vpn_conf = utils.JINJA_ENV.get_template('virtual_router/features/vpn.j2').render(**template_data)
+            template = utils.JINJA_ENV.get_template('virtual_router/features/vpn.j2')
+            vpn_conf = template.render(**template_data)
             VirtualRouter.logger.debug(f'Generated vpn conf for virtual_router #{virtual_router_id}\n{vpn_conf}')
 
         child_span.finish()
@@ -136,130 +162,121 @@ class VirtualRouter(LinuxMixin):
         management_ip = template_data.pop('management_ip')
         built = False
 
-        client = SSHClient()
-        client.set_missing_host_key_policy(AutoAddPolicy())
-        key = RSAKey.from_private_key_file('/root/.ssh/id_rsa')
-        sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
         try:
-            # Try connecting to the host and running the necessary commands
-            # No need for password as it should have keys
-            sock.connect((management_ip, 22))
-            client.connect(hostname=management_ip, username='robot', pkey=key, timeout=30, sock=sock)
-            sftp = client.open_sftp()
-            span.set_tag('host', management_ip)
-
-            # First check if Floating subnet bridge exists on the PodNet netplan directory otherwise create it.
-            # this check is only for build task
-            ipv4_subnet_id = template_data.pop('ipv4_floating_subnet_id')
-            VirtualRouter.logger.debug(
-                f'Checking the Floating subnet bridge for Subnet id #{ipv4_subnet_id}',
-            )
-            floating_bridge_file = f'/etc/netplan/{ipv4_subnet_id}-config.yaml'
-            try:
-                sftp.open(floating_bridge_file, mode='r')
-            except IOError:
-                VirtualRouter.logger.debug(
-                    f'Floating subnet Bridge not found for id #{ipv4_subnet_id}, so creating the bridge.',
-                )
-                floating_bridge = utils.JINJA_ENV.get_template(
-                    'virtual_router/features/floating_bridge.j2',
-                ).render(**template_data, ipv4_floating_subnet_id=ipv4_subnet_id)
+            # Borrow a connected client for the PodNet box from the pool and run the necessary commands
+            with ssh_pool.borrow(management_ip, 'robot') as client:
+                span.set_tag('host', management_ip)
+
+                # Gather all of the files that need to be written to the PodNet box, so they can be sent together
+                files: Dict[str, str] = {}
+
+                # First check if Floating subnet bridge exists on the PodNet netplan directory otherwise create it.
+                # this check is only for build task
+                ipv4_subnet_id = template_data.pop('ipv4_floating_subnet_id')
                 VirtualRouter.logger.debug(
-                    f'Generated build floating subnet bridge for Subnet '
-                    f'#{ipv4_subnet_id}\n{floating_bridge}',
+                    f'Checking the Floating subnet bridge for Subnet id #{ipv4_subnet_id}',
                 )
-                temp_floating_bridge_file = f'{remote_path}{ipv4_subnet_id}-config.yaml'
+                floating_bridge_file = f'/etc/netplan/{ipv4_subnet_id}-config.yaml'
+                temp_floating_bridge_file = None
+                with client.open_sftp() as sftp:
+                    try:
+                        sftp.stat(floating_bridge_file)
+                        bridge_exists = True
+                    except IOError:
+                        bridge_exists = False
+                if not bridge_exists:
+                    VirtualRouter.logger.debug(
+                        f'Floating subnet Bridge not found for id #{ipv4_subnet_id}, so creating the bridge.',
+                    )
+                    template = utils.JINJA_ENV.get_template('virtual_router/features/floating_bridge.j2')
+                    floating_bridge = template.render(**template_data, ipv4_floating_subnet_id=ipv4_subnet_id)
+                    VirtualRouter.logger.debug(
+                        f'Generated build floating subnet bridge for Subnet '
+                        f'#{ipv4_subnet_id}\n{floating_bridge}',
+                    )
+                    temp_floating_bridge_file = f'{remote_path}{ipv4_subnet_id}-config.yaml'
+                    files[temp_floating_bridge_file] = floating_bridge
+
+                # Firewall rules file .nft and vpn.conf file(if any)
+                firewall_filename = template_data.pop('firewall_filename')
+                files[f'{remote_path}{firewall_filename}'] = firewall_nft
+                if len(virtual_router_data['vpns']) > 0:
+                    temp_vpn_filename = template_data.pop('temp_vpn_filename')
+                    files[temp_vpn_filename] = vpn_conf
+
+                # Secondly, Write all of the files to the PodNet box in one go
+                child_span = opentracing.tracer.start_span('write_files_to_podnet_box', child_of=span)
                 try:
-                    with sftp.open(temp_floating_bridge_file, mode='w', bufsize=1) as yaml:
-                        yaml.write(floating_bridge)
+                    VirtualRouter.upload_files(files, client, child_span)
                     VirtualRouter.logger.debug(
-                        f'Successfully wrote file {temp_floating_bridge_file} to PodNet box#{management_ip}',
+                        f'Successfully wrote files {", ".join(files)} to PodNet box#{management_ip}',
                     )
-                    # move temp file to netplan dir and apply netplan changes
-                    child_span = opentracing.tracer.start_span('apply_netplan_changes', child_of=span)
-                    netplan_cmd = f'sudo mv {temp_floating_bridge_file} {floating_bridge_file} && sudo netplan apply'
-                    stdout, stderr = VirtualRouter.deploy(netplan_cmd, client, child_span)
-                    child_span.finish()
-                    if stderr:
-                        VirtualRouter.logger.error(
-                            f'Applying netplan changes for PodNet #{management_ip} generated stderr: \n{stderr}',
-                        )
-                        virtual_router_data['errors'].append(stderr)
-                    else:
-                        VirtualRouter.logger.debug(
-                            f'Applying netplan changes for PodNet #{management_ip} generated stdout: \n{stdout}',
-                        )
-
                 except IOError as err:
                     VirtualRouter.logger.error(
-                        f'Failed to write file {temp_floating_bridge_file} to PodNet box#{management_ip}',
+                        f'Failed to write files {", ".join(files)} to PodNet box#{management_ip}',
                         exc_info=True,
                     )
                     virtual_router_data['errors'].append(err)
                     return False
+                finally:
+                    child_span.finish()
 
-            # Secondly, Write Firewall rules file .nft and vpn.conf file(if any) to PodNet box
-            child_span = opentracing.tracer.start_span('write_files_to_podnet_box', child_of=span)
-            firewall_filename = template_data.pop('firewall_filename')
-            try:
-                with sftp.open(f'{remote_path}{firewall_filename}', mode='w', bufsize=1) as firewall:
-                    firewall.write(firewall_nft)
+                # Finally, Attempt to execute ALL of the virtual router build commands
+                # which includes firewall rules and vpns(if any).
+                # Moving the floating bridge into place and applying netplan is done by the same script, so the whole
+                # build is run over a single channel, and the output of each stage is split back out afterwards
+                stages: List[Tuple[str, str]] = []
+                if temp_floating_bridge_file is not None:
+                    stages.append((
+                        'netplan',
+                        f'sudo mv {temp_floating_bridge_file} {floating_bridge_file} && sudo netplan apply',
+                    ))
+                stages.append(('build', build_bash_script))
                 VirtualRouter.logger.debug(
-                    f'Successfully wrote file {firewall_filename} to PodNet box#{management_ip}',
+                    f'Executing Virtual Router build commands for virtual_router #{virtual_router_id}',
                 )
-            except IOError as err:
-                VirtualRouter.logger.error(
-                    f'Failed to write file {firewall_filename} to PodNet box#{management_ip}',
-                    exc_info=True,
+                child_span = opentracing.tracer.start_span('build_virtual_router', child_of=span)
+                stdout, stderr = VirtualRouter.deploy(
+                    'bash -s',
+                    client,
+                    child_span,
+                    stdin_script=VirtualRouter.staged_script(stages),
                 )
-                virtual_router_data['errors'].append(err)
-                return False
+                child_span.finish()
+                stage_stdout = VirtualRouter.split_stages(stdout)
+                stage_stderr = VirtualRouter.split_stages(stderr)
 
-            if len(virtual_router_data['vpns']) > 0:
-                temp_vpn_filename = template_data.pop('temp_vpn_filename')
-                try:
-                    with sftp.open(temp_vpn_filename, mode='w', bufsize=1) as vpn:
-                        vpn.write(vpn_conf)
-                    VirtualRouter.logger.debug(
-                        f'Successfully wrote file {temp_vpn_filename} to PodNet box#{management_ip}',
-                    )
-                except IOError as err:
+                if temp_floating_bridge_file is not None:
+                    if stage_stderr.get('netplan'):
+                        VirtualRouter.logger.error(
+                            f'Applying netplan changes for PodNet #{management_ip} generated stderr: \n'
+                            f'{stage_stderr["netplan"]}',
+                        )
+                        virtual_router_data['errors'].append(stage_stderr['netplan'])
+                    else:
+                        VirtualRouter.logger.debug(
+                            f'Applying netplan changes for PodNet #{management_ip} generated stdout: \n'
+                            f'{stage_stdout.get("netplan", "")}',
+                        )
+
+                if stage_stderr.get('build'):
                     VirtualRouter.logger.error(
-                        f'Failed to write file {temp_vpn_filename} to PodNet box#{management_ip}',
-                        exc_info=True,
+                        f'Virtual Router build commands for virtual_router #{virtual_router_id} generated stderr.'
+                        f'\n{stage_stderr["build"]}',
                     )
-                    virtual_router_data['errors'].append(err)
-                    return False
-            child_span.finish()
-
-            # Finally, Attempt to execute ALL of the virtual router build commands
-            # which includes firewall rules and vpns(if any).
-            VirtualRouter.logger.debug(
-                f'Executing Virtual Router build commands for virtual_router #{virtual_router_id}',
-            )
-            child_span = opentracing.tracer.start_span('build_virtual_router', child_of=span)
-            stdout, stderr = VirtualRouter.deploy(build_bash_script, client, child_span)
-            child_span.finish()
-            if stderr:
-                VirtualRouter.logger.error(
-                    f'Virtual Router build commands for virtual_router #{virtual_router_id} generated stderr.'
-                    f'\n{stderr}',
-                )
-                virtual_router_data['errors'].append(stderr)
-            else:
-                VirtualRouter.logger.debug(
-                    f'Virtual Router build commands for virtual_router #{virtual_router_id} generated stdout.'
-                    f'\n{stdout}',
-                )
-                built = True
+                    virtual_router_data['errors'].append(stage_stderr['build'])
+                else:
+                    VirtualRouter.logger.debug(
+                        f'Virtual Router build commands for virtual_router #{virtual_router_id} generated stdout.'
+                        f'\n{stage_stdout.get("build", "")}',
+                    )
+                    built = True
 
         except (OSError, SSHException, TimeoutError):
             error = f'Exception occurred while building virtual_router #{virtual_router_id} in {management_ip}'
             VirtualRouter.logger.error(error, exc_info=True)
             virtual_router_data['errors'].append(error)
             span.set_tag('failed_reason', 'ssh_error')
-        finally:
-            client.close()
 
         return built
 
@@ -286,17 +303,17 @@ class VirtualRouter(LinuxMixin):
         data['ipv4_floating_subnet_id'] = virtual_router_data['ip_address']['subnet']['id']
         data['virtual_router_gateway'] = virtual_router_data['ip_address']['subnet']['gateway']
         # PODnet CPE required for VPNs
-        data['podnet_cpe'] = settings.PODNET_CPE
+        data['podnet_cpe'] = PODNET_CPE
 
         # Get the vlans and nat rules for the virtual_router
-        vlans: Deque[Dict[str, str]] = deque()
-        nats: Deque[Dict[str, str]] = deque()
-        local_subnets: Deque[Dict[str, str]] = deque()
+        vlans: List[Dict[str, str]] = []
+        nats: List[Dict[str, str]] = []
+        local_subnets: List[Dict[str, str]] = []
 
         subnets = virtual_router_data['subnets']
-        # Add the vlan information to the deque
+        # Add the vlan information to the list
         for subnet in subnets:
-            sub = IPNetwork(subnet['address_range'])
+            sub = _cidr(subnet['address_range'])
             vlans.append({
                 'address_family': sub.version,
                 'address_range': subnet['address_range'],
@@ -310,13 +327,21 @@ class VirtualRouter(LinuxMixin):
         data['local_subnets'] = local_subnets
 
         # Check if there are any NAT rules needed in this subnet by filtering ips in subnet that have a public_ip_id
-        params = {
+        nat_params = {
             'search[subnet_id__in]': [subnet['id'] for subnet in subnets],
             'search[public_ip_id__isnull]': False,
         }
-        child_span = opentracing.tracer.start_span('listing_ip_addresses', child_of=span)
-        nat_ips = utils.api_list(IAAS.ip_address, params, span=child_span)
-        child_span.finish()
+        # Get the VPNs for the Project at the same time, as the two listings don't depend on each other
+        vpn_params = {'search[virtual_router_id]': virtual_router_id}
+        nat_span = opentracing.tracer.start_span('listing_ip_addresses', child_of=span)
+        vpn_span = opentracing.tracer.start_span('listing_vpns', child_of=span)
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            nat_future = executor.submit(utils.api_list, IAAS.ip_address, nat_params, span=nat_span)
+            vpn_future = executor.submit(utils.api_list, IAAS.vpn, vpn_params, span=vpn_span)
+            nat_ips = nat_future.result()
+            nat_span.finish()
+            virtual_router_vpns = vpn_future.result()
+            vpn_span.finish()
         for ip in nat_ips:
             nats.append({
                 'private_address': ip['address'],
@@ -325,59 +350,65 @@ class VirtualRouter(LinuxMixin):
         data['nats'] = nats
 
         # Router information
-        data['management_ip'] = settings.MGMT_IP
-        data['private_interface'] = settings.PRIVATE_INF
-        data['public_interface'] = settings.PUBLIC_INF
-
-        # Firewall rules
-        inbound_firewall_rules: Deque[Dict[str, Any]] = deque()
-        outbound_firewall_rules: Deque[Dict[str, Any]] = deque()
-
-        for rule in sorted(virtual_router_data['firewall_rules'], key=lambda fw: fw['order']):
+        data['management_ip'] = MGMT_IP
+        data['private_interface'] = PRIVATE_INF
+        data['public_interface'] = PUBLIC_INF
+
+        # Firewall rules, split into (outbound, inbound) by whether the destination is private
+        firewall_rules: Tuple[List[Dict[str, Any]], List[Dict[str, Any]]] = ([], [])
+        rules = virtual_router_data['firewall_rules']
+        # The rules are updated in place below anyway, so they can be sorted in place too
+        rules.sort(key=itemgetter('order'))
+        for rule in rules:
             # logging
-            rule['log'] = True if rule['pci_logging'] else rule['debug_logging']
+            rule['log'] = rule['pci_logging'] or rule['debug_logging']
             # Determine if it is IPv4 or IPv6
-            rule['address_family'] = IPNetwork(rule['destination']).version
+            destination = _cidr(rule['destination'])
+            rule['address_family'] = destination.version
 
             # Check port and protocol to allow any port for a specific protocol
             if rule['port'] is None:
                 rule['port'] = '0-65535'
 
-            if IPNetwork(rule['destination']).is_private():
-                inbound_firewall_rules.append(rule)
-            else:
-                outbound_firewall_rules.append(rule)
+            firewall_rules[destination.is_private()].append(rule)
 
-        data['inbound_firewall_rules'] = inbound_firewall_rules
-        data['outbound_firewall_rules'] = outbound_firewall_rules
+        data['outbound_firewall_rules'], data['inbound_firewall_rules'] = firewall_rules
 
-        # Finally, get the VPNs for the Project
-        vpns: Deque[Dict[str, Any]] = deque()
-        params = {'search[virtual_router_id]': virtual_router_id}
-        child_span = opentracing.tracer.start_span('listing_vpns', child_of=span)
-        virtual_router_vpns = utils.api_list(IAAS.vpn, params, span=child_span)
-        child_span.finish()
+        # Finally, the VPNs for the Project
+        vpns: List[Dict[str, Any]] = []
+
+        # The VPN list doesn't include email addresses, so read the VPNs that send emails concurrently up front rather
+        # than one after another in the loop
+        email_vpn_ids = [vpn['id'] for vpn in virtual_router_vpns if vpn['send_email']]
+        email_vpns: Dict[int, Dict[str, Any]] = {}
+        if len(email_vpn_ids) > 0:
+            child_span = opentracing.tracer.start_span('reading_vpns', child_of=span)
+            with ThreadPoolExecutor(max_workers=min(8, len(email_vpn_ids))) as executor:
+                email_vpns = dict(zip(
+                    email_vpn_ids,
+                    executor.map(lambda pk: utils.api_read(IAAS.vpn, pk=pk, span=child_span), email_vpn_ids),
+                ))
+            child_span.finish()
         for vpn in virtual_router_vpns:
-            routes: Deque[Dict[str, str]] = deque()
-            local_ts = []
-            remote_ts = []
+            routes: List[Dict[str, str]] = []
+            local_ts: Set[str] = set()
+            remote_ts: Set[str] = set()
             for route in vpn['routes']:
-                local = IPNetwork(str(route['local_subnet']['address_range'])).cidr
-                remote = IPNetwork(str(route['remote_subnet'])).cidr
+                local = _cidr(str(route['local_subnet']['address_range'])).cidr
+                remote = _cidr(str(route['remote_subnet'])).cidr
                 routes.append({
                     'id': route['id'],
                     'local': local,
                     'remote': remote,
                 })
-                local_ts.append(str(local))
-                remote_ts.append(str(remote))
+                local_ts.add(str(local))
+                remote_ts.add(str(remote))
 
             vpn['routes'] = routes
             if vpn['traffic_selector']:
-                local_ts_set = set(local_ts)
-                remote_ts_set = set(remote_ts)
-                vpn['local_ts'] = ','.join(local_ts_set)
-                vpn['remote_ts'] = ','.join(remote_ts_set)
+                # Sorted so the rendered config doesn't change between builds when the routes haven't
+                vpn['local_ts'] = ','.join(sorted(local_ts))
+                vpn['remote_ts'] = ','.join(sorted(remote_ts))
             else:
                 vpn['local_ts'] = '0.0.0.0/0'
                 vpn['remote_ts'] = '0.0.0.0/0'
@@ -387,10 +418,8 @@ class VirtualRouter(LinuxMixin):
             vpn['aggressive'] = 'yes' if vpn['ike_mode'] == 'aggressive' else 'no'
             # if send_email is true then read VPN for email addresses
             if vpn['send_email']:
-                child_span = opentracing.tracer.start_span('reading_vpn', child_of=span)
-                vpn['emails'] = utils.api_read(IAAS.vpn, pk=vpn['id'])['emails']
-                child_span.finish()
-                vpn['srx_vpn_name'] = f'https://{settings.PODNET_CPE}/vrf-{project_id}-{vpn["stif_number"]}-vpn'
+                vpn['emails'] = email_vpns[vpn['id']]['emails']
+                vpn['srx_vpn_name'] = f'https://{PODNET_CPE}/vrf-{project_id}-{vpn["stif_number"]}-vpn'
 
             # MAP SRX values to Strongswan values
             vpn['ike_authentication_map'] = vpn_mappings.IKE_AUTHENTICATION_MAP[vpn['ike_authentication']]
@@ -8,27 +8,37 @@ builder class for kvm vms
 # stdlib
 import logging
 import os
-import random
-import shutil
-import socket
+import re
+import secrets
 import string
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from crypt import crypt, mksalt, METHOD_SHA512
-from typing import Any, Dict, Optional, Tuple
+from ipaddress import ip_address
+from typing import Any, DefaultDict, Dict, List, Optional, Tuple
 # lib
 import opentracing
 from jaeger_client import Span
-from netaddr import IPAddress, IPNetwork
-from paramiko import AutoAddPolicy, RSAKey, SSHClient, SSHException
+from netaddr import IPNetwork
+from paramiko import SSHException
 # local
 import settings
+import ssh_pool
 import utils
 from mixins import LinuxMixin, VMImageMixin
+from mixins.vm import NETWORK_DRIVE_BUFFER_SIZE
 
 
 __all__ = [
     'Linux',
 ]
 
+utils.preload_templates(
+    'vm/kvm/bridge/build.j2',
+    'vm/kvm/bridge/definition.j2',
+    'vm/kvm/commands/build.j2',
+)
+
 
 class Linux(LinuxMixin, VMImageMixin):
     """
@@ -38,7 +48,7 @@ class Linux(LinuxMixin, VMImageMixin):
     # Keep a logger for logging messages from this class
     logger = logging.getLogger('robot.builders.vm.linux')
     # Keep track of the keys necessary for the template, so we can ensure that all keys are present before building
-    template_keys = {
+    template_keys = frozenset({
         # the admin password for the vm, unencrypted
         'admin_password',
         # kickstart thing
@@ -95,7 +105,22 @@ class Linux(LinuxMixin, VMImageMixin):
         'vm_identifier',
         # path for vm's .img files located in host
         'vms_path',
+    })
+    # Settings for the images that don't use the defaults, keyed by image id, as (auth, device_type, device_index,
+    # netplan);
+    #   - auth: kickstart thing for old linux oses such as centos7.x or below and rhel7.x or below
+    #   - device_type and device_index: the name of the first nic
+    #   - netplan: netplan in ubuntu 16 complicated so we keep networks
+    _DEFAULT_IMAGE_SETTINGS: Tuple[str, str, int, bool] = ('select', 'ens', 3, True)
+    _IMAGE_SETTINGS: Dict[int, Tuple[str, str, int, bool]] = {
+        6: ('select', 'ens', 3, False),
+        7: ('select', 'eth', 0, False),
+        10: ('', 'eth', 0, True),
+        11: ('', 'eth', 0, True),
+        15: ('', 'eth', 0, True),
     }
+    # Matches the line virt-install writes to stdout once the VM has been created
+    _CREATED_PATTERN = re.compile(rb'.*Domain creation completed')
 
     @staticmethod
     def build(vm_data: Dict[str, Any], span: Span) -> bool:
@@ -121,8 +146,8 @@ class Linux(LinuxMixin, VMImageMixin):
             return False
 
         # Check that all of the necessary keys are present
-        if not all(template_data[key] is not None for key in Linux.template_keys):
-            missing_keys = [f'"{key}"' for key in Linux.template_keys if template_data[key] is None]
+        missing_keys = [f'"{key}"' for key in Linux.template_keys if template_data.get(key) is None]
+        if missing_keys:
             error_msg = f'Template Data Error, the following keys were missing from the VM build data: ' \
                         f'{", ".join(missing_keys)}'
             Linux.logger.error(error_msg)
@@ -150,64 +175,53 @@ class Linux(LinuxMixin, VMImageMixin):
         bridge_build_cmd, vm_build_cmd = Linux._generate_host_commands(vm_id, template_data)
         child_span.finish()
 
-        # Open a client and run the two necessary commands on the host
+        # Borrow a connected client for the host from the pool and run the two necessary commands on it
         built = False
-        client = SSHClient()
-        client.set_missing_host_key_policy(AutoAddPolicy())
-        key = RSAKey.from_private_key_file('/root/.ssh/id_rsa')
-        sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
         try:
-            # Try connecting to the host and running the necessary commands
-            sock.connect((host_ip, 22))
-            client.connect(
-                hostname=host_ip,
-                username='administrator',
-                pkey=key,
-                timeout=30,
-                sock=sock,
-            )  # No need for password as it should have keys
-            span.set_tag('host', host_ip)
-
-            # Attempt to execute the bridge build commands
-            Linux.logger.debug(f'Executing bridge build commands for VM #{vm_id}')
-
-            child_span = opentracing.tracer.start_span('build_bridge', child_of=span)
-            stdout, stderr = Linux.deploy(bridge_build_cmd, client, child_span)
-            child_span.finish()
-
-            if stdout:
-                Linux.logger.debug(f'Bridge build commands for VM #{vm_id} generated stdout.\n{stdout}')
-            if stderr:
-                Linux.logger.error(f'Bridge build commands for VM #{vm_id} generated stderr.\n{stderr}')
-                vm_data['errors'].append(stderr)
-
-            # Now attempt to execute the vm build command
-            Linux.logger.debug(f'Executing vm build command for VM #{vm_id}')
-
-            child_span = opentracing.tracer.start_span('build_vm', child_of=span)
-            stdout, stderr = Linux.deploy(vm_build_cmd, client, child_span)
-            child_span.finish()
-
-            if stdout:
-                Linux.logger.debug(f'VM build command for VM #{vm_id} generated stdout.\n{stdout}')
-            if stderr:
-                Linux.logger.error(f'VM build command for VM #{vm_id} generated stderr.\n{stderr}')
-                vm_data['errors'].append(stderr)
-            built = 'Domain creation completed' in stdout
+            with ssh_pool.borrow(host_ip) as client:
+                span.set_tag('host', host_ip)
+
+                # Attempt to execute the bridge build commands and then the vm build command. They are run as one
+                # command over a single channel, with the output of each split back out afterwards
+                Linux.logger.debug(f'Executing bridge and vm build commands for VM #{vm_id}')
+
+                # The output is checked for the success message line by line as it is streamed back, rather than
+                # searched once the whole thing has been read
+                child_span = opentracing.tracer.start_span('build_vm', child_of=span)
+                stdout, stderr, built = Linux._run_command(
+                    Linux.staged_script([('bridge', bridge_build_cmd), ('vm', vm_build_cmd)]),
+                    client,
+                    child_span,
+                    Linux._CREATED_PATTERN,
+                )
+                child_span.finish()
+                stage_stdout = Linux.split_stages(stdout)
+                stage_stderr = Linux.split_stages(stderr)
+
+                if stage_stdout.get('bridge'):
+                    Linux.logger.debug(
+                        f'Bridge build commands for VM #{vm_id} generated stdout.\n{stage_stdout["bridge"]}',
+                    )
+                if stage_stderr.get('bridge'):
+                    Linux.logger.error(
+                        f'Bridge build commands for VM #{vm_id} generated stderr.\n{stage_stderr["bridge"]}',
+                    )
+                    vm_data['errors'].append(stage_stderr['bridge'])
+
+                if stage_stdout.get('vm'):
+                    Linux.logger.debug(f'VM build command for VM #{vm_id} generated stdout.\n{stage_stdout["vm"]}')
+                if stage_stderr.get('vm'):
+                    Linux.logger.error(f'VM build command for VM #{vm_id} generated stderr.\n{stage_stderr["vm"]}')
+                    vm_data['errors'].append(stage_stderr['vm'])
 
         except (OSError, SSHException, TimeoutError):
             error = f'Exception occurred while building VM #{vm_id} in {host_ip}'
             Linux.logger.error(error, exc_info=True)
             vm_data['errors'].append(error)
             span.set_tag('failed_reason', 'ssh_error')
-        finally:
-            client.close()
 
         # remove all the files created in network drive
-        try:
-            shutil.rmtree(path)
-        except OSError:
-            Linux.logger.warning(f'Failed to remove network drive files for VM #{vm_id}')
+        Linux.remove_network_drive_files(vm_id, path)
 
         return built
 
@@ -223,7 +237,8 @@ class Linux(LinuxMixin, VMImageMixin):
         """
         vm_id = vm_data['id']
         Linux.logger.debug(f'Compiling template data for VM #{vm_id}')
-        data: Dict[str, Any] = {key: None for key in Linux.template_keys}
+        # Only the keys that can be found are added, any that are left out are reported as missing by the build method
+        data: Dict[str, Any] = {}
 
         data['vm_identifier'] = f'{vm_data["project"]["id"]}_{vm_id}'
         data['image_filename'] = vm_data['image']['filename']
@@ -254,9 +269,10 @@ class Linux(LinuxMixin, VMImageMixin):
         data['admin_password'] = admin_password
         # Also save the password back to the VM data dict
         vm_data['admin_password'] = admin_password
-        data['crypted_admin_password'] = str(crypt(admin_password, mksalt(METHOD_SHA512)))
-        root_password = Linux._password_generator(size=128)
-        data['crypted_root_password'] = str(crypt(root_password, mksalt(METHOD_SHA512)))
+        data['crypted_admin_password'] = crypt(admin_password, mksalt(METHOD_SHA512))
+        # The root password is never used, only its hash, so any 128 random url safe characters will do
+        root_password = secrets.token_urlsafe(96)
+        data['crypted_root_password'] = crypt(root_password, mksalt(METHOD_SHA512))
         data['ssh_public_key'] = vm_data['public_key'] if vm_data['public_key'] not in [None, ''] else False
 
         # Check for the primary storage
@@ -280,41 +296,38 @@ class Linux(LinuxMixin, VMImageMixin):
 
         # The private IPs for the VM will be the one we need to pass to the template
         vm_data['ip_addresses'].reverse()
-        ip_addresses = []
-        subnets = []
+        # Subnets keyed by id, so each subnet is only added once however many of the ips are in it, and the addresses
+        # of the ips grouped by the id of the subnet they are in
+        subnets: Dict[int, Dict[str, Any]] = {}
+        addresses_by_subnet: DefaultDict[int, List[str]] = defaultdict(list)
         for ip in vm_data['ip_addresses']:
-            if IPAddress(ip['address']).is_private():
-                ip_addresses.append(ip)
-                subnets.append({
+            if ip_address(ip['address']).is_private:
+                subnet_id = ip['subnet']['id']
+                addresses_by_subnet[subnet_id].append(ip['address'])
+                subnets.setdefault(subnet_id, {
                     'address_range': ip['subnet']['address_range'],
                     'vlan': ip['subnet']['vlan'],
-                    'id': ip['subnet']['id'],
+                    'id': subnet_id,
                 })
-        # Removing duplicates
-        subnets = [dict(tuple_item) for tuple_item in {tuple(subnet.items()) for subnet in subnets}]
+        gateway_subnet_id = (vm_data['gateway_subnet'] or {}).get('id')
         # sorting nics (each subnet is one nic)
-        for subnet in subnets:
+        for subnet in subnets.values():
             non_default_ips = []
             net = IPNetwork(subnet['address_range'])
-            gateway, netmask = str(net.ip), str(net.netmask)
-            netmask_int = subnet['address_range'].split('/')[1]
+            gateway, netmask, netmask_int = str(net.ip), str(net.netmask), str(net.prefixlen)
             vlan = str(subnet['vlan'])
             data['vlans'].append(vlan)
 
-            for ip_address in ip_addresses:
-                address = ip_address['address']
-                if ip_address['subnet']['id'] == subnet['id']:
-                    # Pick the default ips if any
-                    if vm_data['gateway_subnet'] is not None:
-                        if subnet['id'] == vm_data['gateway_subnet']['id']:
-                            default_ips.append(address)
-                            default_gateway = gateway
-                            default_netmask = netmask
-                            default_netmask_int = netmask_int
-                            default_vlan = vlan
-                            continue
-                    # else store the non gateway subnet ips
-                    non_default_ips.append(address)
+            if subnet['id'] == gateway_subnet_id:
+                # Pick the default ips if any
+                default_ips.extend(addresses_by_subnet[subnet['id']])
+                default_gateway = gateway
+                default_netmask = netmask
+                default_netmask_int = netmask_int
+                default_vlan = vlan
+            else:
+                # else store the non gateway subnet ips
+                non_default_ips = addresses_by_subnet[subnet['id']]
 
             if len(non_default_ips) > 0:
                 data['nics'].append({
@@ -372,38 +385,24 @@ class Linux(LinuxMixin, VMImageMixin):
         data['timezone'] = 'Europe/Dublin'
 
         # Get the ip address of the host
-        host_ip = None
-        for interface in vm_data['server_data']['interfaces']:
-            if interface['enabled'] is True and interface['ip_address'] is not None:
-                if IPAddress(str(interface['ip_address'])).version == 6:
-                    host_ip = interface['ip_address']
-                    break
-        if host_ip is None:
+        host_interface = utils.find_ipv6_interface(vm_data['server_data']['interfaces'])
+        if host_interface is None:
             error = f'Host ip address not found for the server # {vm_data["server_id"]}'
             Linux.logger.error(error)
             vm_data['errors'].append(error)
             return None
-        data['host_ip'] = host_ip
+        data['host_ip'] = host_interface['ip_address']
 
         # Add the host information to the data
         data['host_sudo_passwd'] = settings.NETWORK_PASSWORD
         data['network_drive_path'] = settings.KVM_HOST_NETWORK_DRIVE_PATH
         data['vms_path'] = settings.KVM_VMS_PATH
 
-        # kickstart thing for old linux oses such as centos7.x or below and rhel7.x or below
-        data['auth'] = 'select'
-        if vm_data['image']['id'] in [10, 11, 15]:
-            data['auth'] = ''
-        # device type
-        data['device_type'] = 'ens'
-        data['device_index'] = 3
-        if vm_data['image']['id'] in [7, 10, 11, 15]:
-            data['device_type'] = 'eth'
-            data['device_index'] = 0
-        # netplan in ubuntu 16 complicated so we keep networks
-        data['netplan'] = True
-        if vm_data['image']['id'] in [6, 7]:
-            data['netplan'] = False
+        # Add the settings that depend on the image
+        data['auth'], data['device_type'], data['device_index'], data['netplan'] = Linux._IMAGE_SETTINGS.get(
+            vm_data['image']['id'],
+            Linux._DEFAULT_IMAGE_SETTINGS,
+        )
 
         return data
 
@@ -413,7 +412,7 @@ class Linux(LinuxMixin, VMImageMixin):
         Generate and write files into the network drive so they are on the host for the build scripts to utilise.
         Writes the following files to the drive;
             - answer file
-            - bridge definition file
+            - archive of the bridge definition files
         :param vm_data: The data of the VM read from the API
         :param template_data: The retrieved template data for the kvm vm
         :param path: Network drive location to create above files for VM build
@@ -432,43 +431,57 @@ class Linux(LinuxMixin, VMImageMixin):
             vm_data['errors'].append(f'{error} Error: {err}')
             return False
 
-        # Render and attempt to write the bridge definition file
+        # Render the bridge definition files, which are written to the drive together in one archive that the bridge
+        # build command extracts into /etc/netplan/ on the host
+        # Note: netplan yaml file names must start with numbers, so the files are named by the vlan alone
+        bridge_def_template = utils.JINJA_ENV.get_template('vm/kvm/bridge/definition.j2')
+        bridge_defs: Dict[str, str] = {}
         for vlan in template_data['vlans']:
-            template_name = 'vm/kvm/bridge/definition.j2'
-            bridge_def = utils.JINJA_ENV.get_template(template_name).render(vlan=vlan)
+            bridge_def = bridge_def_template.render(vlan=vlan)
             Linux.logger.debug(f'Generated bridge definition file for VM #{vm_id}\n{bridge_def}')
-            bridge_def_filename = f'{path}/br{vlan}.yaml'
-            try:
-                # Attempt to write
-                with open(bridge_def_filename, 'w') as f:
-                    f.write(bridge_def)
-                Linux.logger.debug(
-                    f'Successfully wrote bridge definition file for VM #{vm_id} to {bridge_def_filename}',
-                )
-            except IOError as err:
-                error = f'Failed to write bridge definition file for VM #{vm_id} to {bridge_def_filename}'
-                Linux.logger.error(error, exc_info=True)
-                vm_data['errors'].append(f'{error} Error: {err}')
-                return False
+            bridge_defs[f'{vlan}.yaml'] = bridge_def
 
-        # Render and attempt to write the answer file
-        template_name = f'vm/kvm/answer_files/{answer_file_name}.j2'
-        answer_file_data = utils.JINJA_ENV.get_template(template_name).render(**template_data)
+        # Render the answer file
+        answer_file_template = utils.JINJA_ENV.get_template(f'vm/kvm/answer_files/{answer_file_name}.j2')
+        answer_file_data = answer_file_template.render(**template_data)
         Linux.logger.debug(f'Generated answer file for VM #{vm_id}\n{answer_file_data}')
-        answer_file_path = f'{path}/{template_data["vm_identifier"]}.cfg'
-        try:
-            # Attempt to write
-            with open(answer_file_path, 'w') as f:
-                f.write(answer_file_data)
-            Linux.logger.debug(f'Successfully wrote answer file for VM #{vm_id} to {answer_file_path}')
-        except IOError as err:
-            error = f'Failed to write answer file for VM #{vm_id} to {answer_file_path}'
-            Linux.logger.error(error, exc_info=True)
-            vm_data['errors'].append(f'{error} Error: {err}')
-            return False
 
-        # Return True as all was successful
-        return True
+        # Attempt to write the files. They are written at the same time, as each one waits on the network drive
+        files = {
+            f'{path}/bridges.tar': ('bridge definition files', Linux.archive_files(bridge_defs)),
+            f'{path}/{template_data["vm_identifier"]}.cfg': ('answer file', answer_file_data.encode()),
+        }
+        with ThreadPoolExecutor(max_workers=len(files)) as executor:
+            writes = {
+                filename: executor.submit(Linux._write_network_drive_file, filename, data)
+                for filename, (_, data) in files.items()
+            }
+
+        success = True
+        for filename, write in writes.items():
+            description = files[filename][0]
+            err = write.exception()
+            if err is None:
+                Linux.logger.debug(f'Successfully wrote {description} for VM #{vm_id} to {filename}')
+            elif isinstance(err, IOError):
+                error = f'Failed to write {description} for VM #{vm_id} to {filename}'
+                Linux.logger.error(error, exc_info=err)
+                vm_data['errors'].append(f'{error} Error: {err}')
+                success = False
+            else:
+                raise err
+        return success
+
+    @staticmethod
+    def _write_network_drive_file(filename: str, data: bytes):
+        """
+        Write the given data to a file on the network drive, in a single buffered write
+        :param filename: The path of the file to write
+        :param data: The contents of the file
+        :raises IOError: If the file could not be written
+        """
+        with open(filename, 'wb', buffering=NETWORK_DRIVE_BUFFER_SIZE) as f:
+            f.write(data)
 
     @staticmethod
     def _generate_host_commands(vm_id: int, template_data: Dict[str, Any]) -> Tuple[str, str]:
@@ -503,4 +516,4 @@ class Linux(LinuxMixin, VMImageMixin):
         """
         if chars is None:
             chars = string.ascii_letters + string.digits
-        return ''.join(random.choice(chars) for _ in range(size))
+        return ''.join(secrets.choice(chars) for _ in range(size))
@@ -9,25 +9,35 @@ builder class for windows vms
 # stdlib
 import logging
 import os
-import random
-import shutil
+import secrets
 import string
-from typing import Any, Dict, Optional
+import zipfile
+from collections import defaultdict
+from io import BytesIO
+from ipaddress import ip_address
+from typing import Any, DefaultDict, Dict, List, Optional
 # lib
 import opentracing
 from jaeger_client import Span
-from netaddr import IPAddress
 from winrm.exceptions import WinRMError
 # local
 import settings
 import utils
 from mixins import VMImageMixin, WindowsMixin
+from mixins.vm import NETWORK_DRIVE_BUFFER_SIZE
 
 
 __all__ = [
     'Windows',
 ]
 
+utils.preload_templates(
+    'vm/hyperv/answer_files/windows.j2',
+    'vm/hyperv/commands/build.j2',
+    'vm/hyperv/commands/network.j2',
+    'vm/hyperv/commands/script.j2',
+)
+
 
 class Windows(WindowsMixin, VMImageMixin):
     """
@@ -37,7 +47,7 @@ class Windows(WindowsMixin, VMImageMixin):
     # Keep a logger for logging messages from this class
     logger = logging.getLogger('robot.builders.vm.windows')
     # Keep track of the keys necessary for the template, so we can ensure that all keys are present before building
-    template_keys = {
+    template_keys = frozenset({
         # the admin password for the vm, unencrypted
         'admin_password',
         # the number of cpus in the vm
@@ -78,7 +88,7 @@ class Windows(WindowsMixin, VMImageMixin):
         'vm_identifier',
         # path for vm's folders files located in host
         'vms_path',
-    }
+    })
 
     @staticmethod
     def build(vm_data: Dict[str, Any], span: Span) -> bool:
@@ -104,8 +114,8 @@ class Windows(WindowsMixin, VMImageMixin):
             return False
 
         # Check that all of the necessary keys are present
-        if not all(template_data[key] is not None for key in Windows.template_keys):
-            missing_keys = [f'"{key}"' for key in Windows.template_keys if template_data[key] is None]
+        missing_keys = [f'"{key}"' for key in Windows.template_keys if template_data.get(key) is None]
+        if missing_keys:
             error_msg = f'Template Data Error, the following keys were missing from the VM build data: ' \
                         f'{", ".join(missing_keys)}'
             Windows.logger.error(error_msg)
@@ -159,10 +169,7 @@ class Windows(WindowsMixin, VMImageMixin):
                 Windows.logger.error(error)
 
         # remove all the files created in network drive
-        try:
-            shutil.rmtree(path)
-        except OSError:
-            Windows.logger.warning(f'Failed to remove network drive files for VM #{vm_id}')
+        Windows.remove_network_drive_files(vm_id, path)
 
         return built
 
@@ -227,38 +234,36 @@ class Windows(WindowsMixin, VMImageMixin):
 
         # The private IPs for the VM will be the one we need to pass to the template
         vm_data['ip_addresses'].reverse()
-        ip_addresses = []
-        subnets = []
+        # Subnets keyed by id, so each subnet is only added once however many of the ips are in it, and the addresses
+        # of the ips grouped by the id of the subnet they are in
+        subnets: Dict[int, Dict[str, Any]] = {}
+        addresses_by_subnet: DefaultDict[int, List[str]] = defaultdict(list)
         for ip in vm_data['ip_addresses']:
-            if IPAddress(ip['address']).is_private():
-                ip_addresses.append(ip)
-                subnets.append({
+            if ip_address(ip['address']).is_private:
+                subnet_id = ip['subnet']['id']
+                addresses_by_subnet[subnet_id].append(ip['address'])
+                subnets.setdefault(subnet_id, {
                     'address_range': ip['subnet']['address_range'],
                     'vlan': ip['subnet']['vlan'],
-                    'id': ip['subnet']['id'],
+                    'id': subnet_id,
                 })
-        # Removing duplicates
-        subnets = [dict(tuple_item) for tuple_item in {tuple(subnet.items()) for subnet in subnets}]
+        gateway_subnet_id = (vm_data['gateway_subnet'] or {}).get('id')
         # sorting nics (each subnet is one nic)
-        for subnet in subnets:
+        for subnet in subnets.values():
             non_default_ips = []
             gateway, netmask_int = subnet['address_range'].split('/')
             vlan = str(subnet['vlan'])
             data['vlans'].append(vlan)
 
-            for ip_address in ip_addresses:
-                address = ip_address['address']
-                if ip_address['subnet']['id'] == subnet['id']:
-                    # Pick the default ips if any
-                    if vm_data['gateway_subnet'] is not None:
-                        if subnet['id'] == vm_data['gateway_subnet']['id']:
-                            data['default_ips'].append(address)
-                            data['default_gateway'] = gateway
-                            data['default_netmask_int'] = netmask_int
-                            data['default_vlan'] = vlan
-                            continue
-                    # else store the non gateway subnet ips
-                    non_default_ips.append(address)
+            if subnet['id'] == gateway_subnet_id:
+                # Pick the default ips if any
+                data['default_ips'].extend(addresses_by_subnet[subnet['id']])
+                data['default_gateway'] = gateway
+                data['default_netmask_int'] = netmask_int
+                data['default_vlan'] = vlan
+            else:
+                # else store the non gateway subnet ips
+                non_default_ips = addresses_by_subnet[subnet['id']]
 
             if len(non_default_ips) > 0:
                 data['ip_addresses'].append({
@@ -273,20 +278,15 @@ class Windows(WindowsMixin, VMImageMixin):
         data['timezone'] = 'GMT Standard Time'
 
         # Get the host name of the server
-        host_name = None
-        for interface in vm_data['server_data']['interfaces']:
-            if interface['enabled'] is True and interface['ip_address'] is not None:
-                if IPAddress(str(interface['ip_address'])).version == 6:
-                    host_name = interface['hostname']
-                    break
-        if host_name is None:
+        host_interface = utils.find_ipv6_interface(vm_data['server_data']['interfaces'])
+        if host_interface is None:
             error = f'Host name is not found for the server # {vm_data["server_id"]}'
             Windows.logger.error(error)
             vm_data['errors'].append(error)
             return None
 
         # Add the host information to the data
-        data['host_name'] = host_name
+        data['host_name'] = host_interface['hostname']
         data['network_drive_url'] = settings.NETWORK_DRIVE_URL
         data['vms_path'] = settings.HYPERV_VMS_PATH
 
@@ -296,10 +296,12 @@ class Windows(WindowsMixin, VMImageMixin):
     def _generate_network_drive_files(vm_data: Dict[str, Any], template_data: Dict[str, Any], path: str) -> bool:
         """
         Generate and write files into the network drive so they are on the host for the build scripts to utilise.
-        Writes the following files to the drive;
+        Writes a build.zip archive to the drive, containing the following files;
             - unattend.xml
             - network.xml
-            - build.psm1
+            - builder.psm1
+        The files are written in one archive so the network drive only has to create a single file, the build command
+        extracts them on the host
         :param vm_data: The data of the VM read from the API
         :param path: Network drive location to create above files for VM build
         :param template_data: The retrieved template data for the vm
@@ -317,52 +319,36 @@ class Windows(WindowsMixin, VMImageMixin):
             vm_data['errors'].append(f'{error} Error: {err}')
             return False
 
-        # Render and attempt to write the answer file
-        template_name = 'vm/hyperv/answer_files/windows.j2'
-        answer_file_data = utils.JINJA_ENV.get_template(template_name).render(**template_data)
-        template_data.pop('admin_password')
-        answer_file_log = utils.JINJA_ENV.get_template(template_name).render(**template_data)
-        Windows.logger.debug(f'Generated answer file for VM #{vm_id}\n{answer_file_log}')
-        answer_file_path = f'{path}/unattend.xml'
-        try:
-            # Attempt to write
-            with open(answer_file_path, 'w') as f:
-                f.write(answer_file_data)
-            Windows.logger.debug(f'Successfully wrote answer file for VM #{vm_id} to {answer_file_log}')
-        except IOError as err:
-            error = f'Failed to write answer file for VM #{vm_id} to {answer_file_path}.'
-            Windows.logger.error(error, exc_info=True)
-            vm_data['errors'].append(f'{error} Error: {err}')
-            return False
+        # Render the answer file
+        answer_file_data = utils.JINJA_ENV.get_template('vm/hyperv/answer_files/windows.j2').render(**template_data)
+        admin_password = template_data.pop('admin_password')
+        if Windows.logger.isEnabledFor(logging.DEBUG):
+            # Leave the password out of the logs
+            answer_file_log = answer_file_data.replace(admin_password, '')
+            Windows.logger.debug(f'Generated answer file for VM #{vm_id}\n{answer_file_log}')
 
-        # Render and attempt to write the network file
-        template_name = 'vm/hyperv/commands/network.j2'
-        network = utils.JINJA_ENV.get_template(template_name).render(**template_data)
+        # Render the network file
+        network = utils.JINJA_ENV.get_template('vm/hyperv/commands/network.j2').render(**template_data)
         Windows.logger.debug(f'Generated network file for VM #{vm_id}\n{network}')
-        network_file = f'{path}/network.xml'
-        try:
-            # Attempt to write
-            with open(network_file, 'w') as f:
-                f.write(network)
-            Windows.logger.debug(f'Successfully wrote network file for VM #{vm_id} to {network_file}')
-        except IOError as err:
-            error = f'Failed to write network file for VM #{vm_id} to {network_file}.'
-            Windows.logger.error(error, exc_info=True)
-            vm_data['errors'].append(f'{error} Error: {err}')
-            return False
 
-        # Render and attempt to write the build script file
-        template_name = 'vm/hyperv/commands/script.j2'
-        builder = utils.JINJA_ENV.get_template(template_name).render(**template_data)
+        # Render the build script file
+        builder = utils.JINJA_ENV.get_template('vm/hyperv/commands/script.j2').render(**template_data)
         Windows.logger.debug(f'Generated build script file for VM #{vm_id}\n{builder}')
-        script_file = f'{path}/builder.psm1'
+
+        # Pack the files into an archive and attempt to write it
+        archive = BytesIO()
+        with zipfile.ZipFile(archive, 'w', compression=zipfile.ZIP_DEFLATED) as build_zip:
+            build_zip.writestr('unattend.xml', answer_file_data)
+            build_zip.writestr('network.xml', network)
+            build_zip.writestr('builder.psm1', builder)
+        archive_path = f'{path}/build.zip'
         try:
             # Attempt to write
-            with open(script_file, 'w') as f:
-                f.write(builder)
-            Windows.logger.debug(f'Successfully wrote build script file for VM #{vm_id} to {script_file}')
+            with open(archive_path, 'wb', buffering=NETWORK_DRIVE_BUFFER_SIZE) as f:
+                f.write(archive.getvalue())
+            Windows.logger.debug(f'Successfully wrote build files for VM #{vm_id} to {archive_path}')
         except IOError as err:
-            error = f'Failed to write build script file for VM #{vm_id} to {script_file}.'
+            error = f'Failed to write build files for VM #{vm_id} to {archive_path}.'
             Windows.logger.error(error, exc_info=True)
             vm_data['errors'].append(f'{error} Error: {err}')
             return False
@@ -382,4 +368,4 @@ class Windows(WindowsMixin, VMImageMixin):
         """
         if chars is None:
             chars = string.ascii_letters + string.digits
-        return ''.join(random.choice(chars) for _ in range(size))
+        return ''.join(secrets.choice(chars) for _ in range(size))
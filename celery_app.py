@@ -4,7 +4,8 @@ Celery main runner
 # stdlib
 import atexit
 import logging
-import time
+from threading import Event
+from typing import Dict, Optional
 # lib
 import opentracing
 from celery import Celery
@@ -20,6 +21,9 @@ __all__ = [
     'app',
 ]
 
+# Longest time in seconds to wait after a task for the tracer's reporter to take its spans
+SPAN_FLUSH_TIMEOUT = 1
+
 # Jaeger opentracing.tracer config
 tracer_config = Config(
     config={
@@ -34,20 +38,39 @@ tracer_config = Config(
 )
 
 
+# Every module that defines tasks is listed, so the workers register them all on start up. The dispatchers don't
+# import the tasks, so nothing else would load the task packages in a worker
 app = Celery(
     'robot',
     broker=f'amqp://[{settings.CELERY_HOST}]:5672',
-    include=['tasks'],
+    include=[
+        'tasks',
+        'tasks.backup',
+        'tasks.snapshot',
+        'tasks.virtual_router',
+        'tasks.vm',
+    ],
 )
 # Optional config
 app.conf.timezone = 'Europe/Dublin'
-# Route heartbeat tasks to a different queue than the other tasks
-app.conf.task_routes = {
-    'tasks.scrub': {'queue': 'heartbeat'},
+
+
+def route_task(name: str, *args, **kwargs) -> Optional[Dict[str, str]]:
+    """
+    Pick the queue for a task as it is sent.
+    A plain comparison on the task's name, rather than having celery match glob patterns against it on every dispatch
+    """
+    # Route heartbeat tasks to a different queue than the other tasks
+    if name == 'tasks.scrub':
+        return {'queue': 'heartbeat'}
     # Also send virtual router tasks to a separate queue
-    'tasks.virtual_router.*': {'queue': 'virtual_router'},
+    if name.startswith('tasks.virtual_router.'):
+        return {'queue': 'virtual_router'}
     # All other tasks will be sent to the default queue named 'celery'
-}
+    return None
+
+
+app.conf.task_routes = (route_task,)
 
 # Add cron based jobs
 app.conf.beat_schedule = {
@@ -76,14 +99,25 @@ def setup_logger_and_tracer(*args, **kwargs):
         atexit.register(opentracing.tracer.close)
 
 
-# Sleep after each task to try and flush spans
+# Wait after each task for its spans to be passed to the IO loop
 @task_postrun.connect
-def sleep_to_flush_spans(*args, **kwargs):
+def flush_spans(*args, **kwargs):
     """
-    Flush spans by passing to IO loop, just to be safe
+    Wait for the spans finished by the task to be handed over to the tracer's reporter, instead of sleeping for a
+    fixed time.
+    The reporter sends the spans from its own IO loop thread, so a callback is queued on that loop behind the ones
+    reporting the task's spans, and the task is finished once it has run. Anything still unsent when the worker exits
+    is flushed by closing the tracer.
     """
-    if settings.LOGSTASH_ENABLE:
-        time.sleep(5)
+    if not settings.LOGSTASH_ENABLE:
+        return
+    io_loop = getattr(getattr(opentracing.tracer, 'reporter', None), 'io_loop', None)
+    if io_loop is None:
+        # No reporter running in this process, so there is nothing to wait for
+        return
+    reported = Event()
+    io_loop.add_callback(reported.set)
+    reported.wait(SPAN_FLUSH_TIMEOUT)
 
 
 # Catch all uncaught errors
@@ -7,7 +7,8 @@ of the class is ever instantiated.
 """
 # stdlib
 import logging
-from datetime import datetime
+from threading import Lock
+from time import monotonic
 from typing import cast
 # lib
 from cloudcix.auth import get_admin_token
@@ -25,14 +26,15 @@ class Token:
 
     # Maintain the instance of Token that will be used everywhere
     __instance = None
+    # Held while the instance is created or the token is renewed, so concurrent tasks don't both request a new token
+    __lock = Lock()
 
     def __init__(self):
         # Check to ensure that an instance has not been created yet
         if Token.__instance is not None:
             raise Exception('Trying to instantiate a singleton more than once!')
         # If not, set up everything that we need
-        self._token = get_admin_token()
-        self._created = datetime.utcnow()
+        self._refresh()
         # Save the instance
         Token.__instance = self
 
@@ -40,17 +42,30 @@ class Token:
     @staticmethod
     def get_instance():
         if Token.__instance is None:
-            Token()
+            with Token.__lock:
+                # Check again now that the lock is held, in case another thread created the instance while we waited
+                if Token.__instance is None:
+                    Token()
         return cast(Token, Token.__instance)
 
+    def _refresh(self):
+        """
+        Get a new token, and note when it will need to be renewed.
+        The monotonic clock is used so the expiry isn't affected by changes to the system time
+        """
+        self._token = get_admin_token()
+        self._expires_at = monotonic() + self.THRESHOLD * 60
+
     @property
     def token(self) -> str:
         """
         Retrieve the token, refreshing it beforehand if necessary
         """
-        if (datetime.utcnow() - self._created).seconds / 60 > self.THRESHOLD:
-            # We need to regenerate the token
-            self._token = get_admin_token()
-            self._created = datetime.utcnow()
-            logging.getLogger('robot.cloudcix_token').debug('Generated new token')
+        if monotonic() >= self._expires_at:
+            with Token.__lock:
+                # Check again now that the lock is held, in case another thread renewed the token while we waited
+                if monotonic() >= self._expires_at:
+                    # We need to regenerate the token
+                    self._refresh()
+                    logging.getLogger('robot.cloudcix_token').debug('Generated new token')
         return self._token
@@ -0,0 +1,84 @@
+"""
+small cache for objects read from the CloudCIX API by the dispatchers
+
+Entries are evicted least recently used first once the cache is full, and expire a number of seconds after they were
+stored, so the cache only saves repeated reads of the same object in a short window of dispatches.
+"""
+# stdlib
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+from typing import Any, Hashable, Optional, Tuple
+# lib
+# local
+
+__all__ = [
+    'TTLCache',
+]
+
+
+class TTLCache:
+    """
+    Least recently used cache whose entries expire `ttl` seconds after they are stored.
+    Thread safe, as the phantom dispatches are run from a pool of threads
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 3.0):
+        """
+        :param maxsize: The most entries to keep in the cache at once
+        :param ttl: Number of seconds an entry is valid for after it is stored
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # Maps each key to (expiry time, value), ordered from least to most recently used
+        self._entries: 'OrderedDict[Hashable, Tuple[float, Any]]' = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """
+        Retrieve the value stored for `key`
+        :returns: The value, or None if there is no entry for the key or it has expired
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if monotonic() >= expires_at:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any):
+        """
+        Store `value` for `key`, evicting the least recently used entry if the cache is full
+        """
+        with self._lock:
+            self._entries[key] = (monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def add(self, key: Hashable, value: Any = True) -> bool:
+        """
+        Store `value` for `key` only if there isn't already an entry for it that is still valid.
+        The check and the store are done together, so only one of any number of threads adding the same key succeeds
+        :returns: A flag stating whether or not the value was stored
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and monotonic() < entry[0]:
+                return False
+            self._entries[key] = (monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+            return True
+
+    def invalidate(self, key: Hashable):
+        """
+        Remove the entry for `key`, ie once the object has been changed in the API
+        """
+        with self._lock:
+            self._entries.pop(key, None)
@@ -0,0 +1,94 @@
+"""
+base class and helpers for the dispatchers that pass objects to their celery tasks
+
+Tasks are sent by name with `app.send_task`, rather than calling `.delay` on the task objects, so celery doesn't have
+to build a signature for every dispatch.
+Sending by name means nothing here imports the task modules, so the workers rely on every task package being listed in
+the `include` of the celery app in celery_app.py to register them. A new task package must be added there as well.
+"""
+# stdlib
+import logging
+from typing import Callable, Dict, Iterable, Tuple
+# lib
+# local
+
+__all__ = [
+    'send',
+    'TaskDispatcher',
+    'task_names',
+]
+
+
+def task_names(kind: str, operations: Iterable[str]) -> Dict[str, str]:
+    """
+    Build the names the celery tasks for a kind of object are registered under.
+    Celery names each task after the module and function that define it, ie `tasks.vm.build.build_vm`
+    :param kind: The kind of object the tasks are for, ie 'vm'
+    :param operations: The operations that there are tasks for, ie 'build'
+    :returns: The name of the task for each of the operations
+    """
+    return {operation: f'tasks.{kind}.{operation}.{operation}_{kind}' for operation in operations}
+
+
+def send(task_name: str, obj_id: int):
+    """
+    Send the named task to the queue for the specified object
+    :param task_name: The registered name of the task to send
+    :param obj_id: The id of the object to pass to the task
+    """
+    # Imported here rather than at module scope, so loading the dispatchers doesn't pull in celery
+    from celery_app import app
+    app.send_task(task_name, args=(obj_id,))
+
+
+class TaskDispatcher:
+    """
+    Base class for the dispatchers that just pass objects to their celery tasks.
+    Each of the `operations` is available as a method taking the id of the object to dispatch, ie `VM.build(vm_id)`.
+    The method is made the first time it is accessed and cached on the instance, so after that each dispatch is a
+    plain attribute lookup
+    """
+
+    # Network password used to login to the routers
+    password: str
+    # The kind of object that is dispatched, as used in the task names, ie 'vm'
+    kind: str
+    # The name of the kind of object used in log messages, ie 'VM'
+    label: str
+    # The operations that there are tasks for
+    operations: Tuple[str, ...]
+    # Names of the celery tasks for each of the operations, built from the above when the subclass is defined
+    _tasks: Dict[str, str] = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._tasks = task_names(cls.kind, cls.operations)
+
+    def __init__(self, password: str):
+        self.password = password
+
+    def __getattr__(self, operation: str) -> Callable[[int], None]:
+        """
+        Make the method for dispatching the given operation. Only called when the attribute isn't found normally, ie
+        the first time each operation is dispatched
+        """
+        try:
+            task_name = self._tasks[operation]
+        except KeyError:
+            raise AttributeError(f'{type(self).__name__!r} object has no attribute {operation!r}') from None
+        logger = logging.getLogger(f'robot.dispatchers.{self.kind}.{operation}')
+        label = self.label
+
+        def dispatch(obj_id: int):
+            """
+            Dispatches a celery task for the specified object
+            :param obj_id: The id of the object to dispatch
+            """
+            # log a message about the dispatch, and pass the request to celery
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f'Passing {label} #{obj_id} to the {operation} task queue')
+            send(task_name, obj_id)
+
+        dispatch.__name__ = operation
+        setattr(self, operation, dispatch)
+        return dispatch
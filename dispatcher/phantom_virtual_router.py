@@ -1,244 +1,263 @@
 # stdlib
 import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import wraps
+from time import sleep
+from typing import Any, Callable, Dict
 # lib
 from cloudcix.api.iaas import IAAS
+from requests import RequestException
 # local
 import metrics
 import state
 import utils
 from cloudcix_token import Token
+from ._cache import TTLCache
+
+# The state updates for phantom virtual_routers are sent from these threads, so the main loop doesn't wait on the API
+# for each one in turn and the requests for different virtual_routers overlap
+DISPATCH_EXECUTOR = ThreadPoolExecutor(max_workers=8, thread_name_prefix='phantom-virtual-router')
+# Virtual routers read from the API by quiesce, so repeated quiesces of the same virtual_router in a short window
+# don't each read it again. Entries are removed whenever the virtual_router's state is updated
+_virtual_routers = TTLCache(maxsize=1024, ttl=3.0)
+# Seconds to wait before each retry of a state update that failed with a server or connection error. Once these are
+# used up the update is reported as failed
+API_RETRY_DELAYS = (0.05, 0.2, 1.0)
+# (dispatch, virtual_router id) of the dispatches that are currently running, so a virtual_router that is picked up
+# again before its dispatch has finished isn't dispatched twice. The TTL only matters if a dispatch is stuck
+_in_flight = TTLCache(maxsize=10000, ttl=60.0)
+logger = logging.getLogger('robot.dispatchers.phantom_virtual_router')
+
+
+def _log_dispatch_error(future: Future):
+    """
+    Log any uncaught error raised by a dispatch running in the background, as there is nothing waiting on its result
+    """
+    error = future.exception()
+    if error is not None:
+        logger.error(
+            'Uncaught error occurred in a phantom virtual_router dispatch.',
+            exc_info=error,
+        )
+
+
+Dispatch = Callable[['PhantomVirtualRouter', int], None]
+
+
+def _in_background(dispatch: Dispatch) -> Dispatch:
+    """
+    Run the decorated dispatch in DISPATCH_EXECUTOR, returning as soon as it has been submitted, the same way the
+    other dispatchers return once their task has been passed to celery.
+    The dispatch is skipped if the same one is already running for the virtual_router
+    """
+    @wraps(dispatch)
+    def submit(self: 'PhantomVirtualRouter', virtual_router_id: int):
+        key = (dispatch.__name__, virtual_router_id)
+        if not _in_flight.add(key):
+            # Already being dispatched
+            return
+        future = DISPATCH_EXECUTOR.submit(dispatch, self, virtual_router_id)
+        future.add_done_callback(_log_dispatch_error)
+        future.add_done_callback(lambda _: _in_flight.invalidate(key))
+    return submit
 
 
 class PhantomVirtualRouter:
     """
     A phantom virtual router dispatcher that just updates the state of the objects to whatever state they should end up.
     Used in systems where Robot does not / cannot build virtual_routers
+    Nothing is actually done to a phantom virtual_router, so nothing waits on it in the in progress states
+    (BUILDING, QUIESCING, etc), and each dispatch sets the final state directly in a single request.
     """
+    # Keep a logger for each of the dispatches, rather than fetching them on every call
+    loggers = {
+        dispatch: logging.getLogger(f'robot.dispatchers.phantom_virtual_router.{dispatch}')
+        for dispatch in ('build', 'quiesce', 'restart', 'scrub', 'update')
+    }
+    # The (state, state name) a quiesce leaves a virtual_router in, for each of the states it can be quiesced from
+    _QUIESCE_TARGETS = {
+        state.QUIESCE: (state.QUIESCED, 'QUIESCED'),
+        state.SCRUB: (state.SCRUB_QUEUE, 'SCRUB_QUEUE'),
+    }
+    # The (state, state name) an update leaves a virtual_router in, for the states that aren't updated to RUNNING
+    _UPDATE_TARGETS = {
+        state.QUIESCED_UPDATE: (state.QUIESCED, 'QUIESCED'),
+    }
 
+    @staticmethod
+    def _set_state(
+            token: str,
+            virtual_router_id: int,
+            new_state: int,
+            state_name: str,
+            logger: logging.Logger,
+            partial: bool = False,
+    ) -> bool:
+        """
+        Update the state of the specified phantom virtual_router in the API
+        :param token: The token to make the request with, fetched once by the calling dispatch
+        :param virtual_router_id: The id of the virtual_router to update
+        :param new_state: The state to update the virtual_router to
+        :param state_name: The name of the state, used for log messages
+        :param logger: The logger of the dispatch that is updating the state
+        :param partial: Flag stating whether to send a partial_update instead of an update
+        :returns: A flag stating whether or not the update was successful
+        """
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(f'Updating phantom virtual_router #{virtual_router_id} to state {state_name}')
+        method = IAAS.virtual_router.partial_update if partial else IAAS.virtual_router.update
+        # Server and connection errors are usually transient, so they are retried after a short wait, backing off each
+        # time. Any other response is final
+        for retry_delay in (*API_RETRY_DELAYS, None):
+            try:
+                response = method(
+                    token=token,
+                    pk=virtual_router_id,
+                    data={'state': new_state},
+                )
+            except RequestException:
+                if retry_delay is None:
+                    logger.error(
+                        f'Could not connect to the API to update phantom virtual_router #{virtual_router_id} '
+                        f'to state {state_name}',
+                        exc_info=True,
+                    )
+                    return False
+                reason = 'a connection error'
+            else:
+                if response.status_code < 500 or retry_delay is None:
+                    break
+                reason = f'HTTP {response.status_code}'
+            logger.warning(
+                f'Retrying the update of phantom virtual_router #{virtual_router_id} to state {state_name} '
+                f'in {retry_delay}s after {reason}',
+            )
+            sleep(retry_delay)
+        if response.status_code != 200:
+            # The body is only read and decoded for the log message, and only if it will be logged
+            if logger.isEnabledFor(logging.ERROR):
+                logger.error(
+                    f'HTTP {response.status_code} error occurred when updating phantom virtual_router '
+                    f'#{virtual_router_id} to state {state_name}\nResponse Text: {response.content.decode()}',
+                )
+            return False
+        # The cached copy of the virtual_router is out of date now
+        _virtual_routers.invalidate(virtual_router_id)
+        return True
+
+    @staticmethod
+    def _read(virtual_router_id: int) -> Dict[str, Any]:
+        """
+        Read the specified virtual_router from the API, or from the cache if it was read in the last few seconds
+        :param virtual_router_id: The id of the virtual_router to read
+        :returns: The virtual_router, or an empty dict if it couldn't be read
+        """
+        virtual_router = _virtual_routers.get(virtual_router_id)
+        if virtual_router is None:
+            virtual_router = utils.api_read(IAAS.virtual_router, virtual_router_id)
+            if virtual_router:
+                _virtual_routers.set(virtual_router_id, virtual_router)
+        return virtual_router
+
+    @_in_background
     def build(self, virtual_router_id: int):
         """
         Takes virtual_router data from the CloudCIX API, adds any additional data needed for building it and
         requests to build it in the assigned physical Router.
         :param virtual_router_id: The virtual_router data from the CloudCIX API
         """
-        logger = logging.getLogger('robot.dispatchers.phantom_virtual_router.build')
-        logger.info(f'Updating phantom virtual router #{virtual_router_id} to state BUILDING')
-        # Change the state to BUILDING and report a success to influx
-        response = IAAS.virtual_router.update(
-            token=Token.get_instance().token,
-            pk=virtual_router_id,
-            data={'state': state.BUILDING},
-        )
-        if response.status_code != 200:
-            logger.error(
-                f'HTTP {response.status_code} error occurred when updating phantom virtual_router #{virtual_router_id} '
-                f'to state BUILDING\nResponse Text: {response.content.decode()}',
-            )
-            metrics.virtual_router_build_failure()
-        logger.info(f'Updating virtual_router #{virtual_router_id} to state RUNNING')
+        logger = PhantomVirtualRouter.loggers['build']
+        token = Token.get_instance().token
         # Change the state to RUNNING and report a success to influx
-        response = IAAS.virtual_router.update(
-            token=Token.get_instance().token,
-            pk=virtual_router_id,
-            data={'state': state.RUNNING},
-        )
-        if response.status_code != 200:
-            logger.error(
-                f'HTTP {response.status_code} error occurred when updating phantom virtual_router #{virtual_router_id} '
-                f'to state RUNNING\nResponse Text: {response.content.decode()}',
-            )
-            metrics.virtual_router_build_failure()
-        else:
+        if PhantomVirtualRouter._set_state(token, virtual_router_id, state.RUNNING, 'RUNNING', logger):
             metrics.virtual_router_build_success()
+        else:
+            metrics.virtual_router_build_failure()
 
+    @_in_background
     def quiesce(self, virtual_router_id: int):
         """
         Takes virtual_router data from the CloudCIX API, it and requests to quiesce the virtual_router
         in the assigned physical Router.
         :param virtual_router_id: The virtual_router data from the CloudCIX API
         """
-        logger = logging.getLogger('robot.dispatchers.phantom_virtual_router.quiesce')
+        logger = PhantomVirtualRouter.loggers['quiesce']
+        token = Token.get_instance().token
         # In order to change the state to the correct value we need to read the virtual_router and check its state
-        virtual_router = utils.api_read(IAAS.virtual_router, virtual_router_id)
+        virtual_router = PhantomVirtualRouter._read(virtual_router_id)
         if not bool(virtual_router):
             return
-        if virtual_router['state'] == state.QUIESCE:
-            logger.info(f'Updating phantom virtual_router #{virtual_router_id} to state QUIESCING')
-            response = IAAS.virtual_router.partial_update(
-                token=Token.get_instance().token,
-                pk=virtual_router_id,
-                data={'state': state.QUIESCING},
-            )
-            if response.status_code != 200:
-                logger.error(
-                    f'Could not update phantom virtual_router #{virtual_router_id} to state QUIESCING.\n'
-                    f'Response: {response.content.decode()}.',
-                )
-                metrics.virtual_router_quiesce_failure()
-                return
-            logger.info(f'Updating phantom virtual_router #{virtual_router_id} to state QUIESCED')
-            response = IAAS.virtual_router.partial_update(
-                token=Token.get_instance().token,
-                pk=virtual_router_id,
-                data={'state': state.QUIESCED},
-            )
-            if response.status_code != 200:
-                logger.error(
-                    f'Could not update phantom virtual_router #{virtual_router_id} to state QUIESCED.\n'
-                    f'Response: {response.content.decode()}.',
-                )
-                metrics.virtual_router_quiesce_failure()
-                return
+        if virtual_router['state'] in (state.QUIESCED, state.SCRUB_QUEUE):
+            # The virtual_router is already where the quiesce would leave it, ie from an earlier dispatch
             metrics.virtual_router_quiesce_success()
-        elif virtual_router['state'] == state.SCRUB:
-            logger.info(f'Updating phantom virtual_router #{virtual_router_id} to state SCRUB_PREP')
-            response = IAAS.virtual_router.partial_update(
-                token=Token.get_instance().token,
-                pk=virtual_router_id,
-                data={'state': state.SCRUB_PREP},
-            )
-            if response.status_code != 200:
-                logger.error(
-                    f'Could not phantom update virtual_router #{virtual_router_id} to state SCRUB_PREP.\n'
-                    f'Response: {response.content.decode()}.',
-                )
-                metrics.virtual_router_quiesce_failure()
-                return
-            logger.info(f'Updating phantom virtual_router #{virtual_router_id} to state SCRUB_QUEUE')
-            response = IAAS.virtual_router.partial_update(
-                token=Token.get_instance().token,
-                pk=virtual_router_id,
-                data={'state': state.SCRUB_QUEUE},
-            )
-            if response.status_code != 200:
-                logger.error(
-                    f'Could not update phantom virtual_router #{virtual_router_id} to state SCRUB_QUEUE.\n'
-                    f'Response: {response.content.decode()}.',
-                )
-                metrics.virtual_router_quiesce_failure()
-                return
-            metrics.virtual_router_quiesce_success()
-        else:
+            return
+        target = PhantomVirtualRouter._QUIESCE_TARGETS.get(virtual_router['state'])
+        if target is None:
             logger.error(
                 f'Phantom virtual_router #{virtual_router_id} has been quiesced despite not being in a valid state. '
                 f'Valid states: [{state.QUIESCE}, {state.SCRUB}], virtual_router is in state {virtual_router["state"]}',
             )
             metrics.virtual_router_quiesce_failure()
+            return
+        if PhantomVirtualRouter._set_state(token, virtual_router_id, *target, logger, True):
+            metrics.virtual_router_quiesce_success()
+        else:
+            metrics.virtual_router_quiesce_failure()
 
+    @_in_background
     def restart(self, virtual_router_id: int):
         """
         Takes virtual_router data from the CloudCIX API, it and requests to restart the virtual_router
         in the assigned physical Router.
         :param virtual_router_id: The virtual_router data from the CloudCIX API
         """
-        logger = logging.getLogger('robot.dispatchers.phantom_virtual_router.restart')
-        logger.info(f'Updating virtual_router #{virtual_router_id} to state RESTARTING')
-        response = IAAS.virtual_router.update(
-            token=Token.get_instance().token,
-            pk=virtual_router_id,
-            data={'state': state.RESTARTING},
-        )
-        if response.status_code != 200:
-            logger.error(
-                f'HTTP {response.status_code} error occurred when updating phantom virtual_router #{virtual_router_id}'
-                f'to state RESTARTING\nResponse Text: {response.content.decode()}',
-            )
-            metrics.virtual_router_restart_failure()
-        logger.info(f'Updating phantom virtual_router #{virtual_router_id} to state RUNNING')
+        logger = PhantomVirtualRouter.loggers['restart']
+        token = Token.get_instance().token
         # Change the state of the virtual_router to RUNNING and report a success to influx
-        response = IAAS.virtual_router.update(
-            token=Token.get_instance().token,
-            pk=virtual_router_id,
-            data={'state': state.RUNNING},
-        )
-        if response.status_code != 200:
-            logger.error(
-                f'HTTP {response.status_code} error occurred when updating virtual_router #{virtual_router_id} '
-                f'to state RUNNING\nResponse Text: {response.content.decode()}',
-            )
-            metrics.virtual_router_restart_failure()
-        else:
+        if PhantomVirtualRouter._set_state(token, virtual_router_id, state.RUNNING, 'RUNNING', logger):
             metrics.virtual_router_restart_success()
+        else:
+            metrics.virtual_router_restart_failure()
 
+    @_in_background
     def scrub(self, virtual_router_id: int):
         """
         Takes virtual_router data from the CloudCIX API, it and requests to scrub the virtual_router
         in the assigned physical Router.
         :param virtual_router_id: The virtual_router data from the CloudCIX API
         """
-        logger = logging.getLogger('robot.dispatchers.phantom_virtual_router.scrub')
-        logger.debug(f'Scrubbing phantom virtual_router #{virtual_router_id}')
-        logger.info(f'Updating phantom virtual_router #{virtual_router_id} to state SCRUBBING')
-
-        response = IAAS.virtual_router.partial_update(
-            token=Token.get_instance().token,
-            pk=virtual_router_id,
-            data={'state': state.SCRUBBING},
-        )
-
-        if response.status_code != 200:
-            logger.error(
-                f'HTTP {response.status_code} error occurred when updating virtual_router #{virtual_router_id} '
-                f'to state CLOSED\nResponse Text: {response.content.decode()}',
-            )
-            metrics.virtual_router_scrub_failure()
-
-        logger.debug(f'Closing phantom virtual_router #{virtual_router_id}')
-        logger.info(f'Updating phantom virtual_router #{virtual_router_id} to state CLOSED')
-        response = IAAS.virtual_router.partial_update(
-            token=Token.get_instance().token,
-            pk=virtual_router_id,
-            data={'state': state.CLOSED},
-        )
-
-        if response.status_code != 200:
-            logger.error(
-                f'HTTP {response.status_code} error occurred when updating virtual_router #{virtual_router_id} '
-                f'to state CLOSED\nResponse Text: {response.content.decode()}',
-            )
-            metrics.virtual_router_scrub_failure()
-        else:
+        logger = PhantomVirtualRouter.loggers['scrub']
+        token = Token.get_instance().token
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f'Closing phantom virtual_router #{virtual_router_id}')
+        if PhantomVirtualRouter._set_state(token, virtual_router_id, state.CLOSED, 'CLOSED', logger, True):
             metrics.virtual_router_scrub_success()
+        else:
+            metrics.virtual_router_scrub_failure()
 
+    @_in_background
     def update(self, virtual_router_id: int):
         """
         Takes virtual_router data from the CloudCIX API, it and requests to update the virtual_router
         in the assigned physical Router.
         :param virtual_router_id: The virtual_router data from the CloudCIX API
         """
-        logger = logging.getLogger('robot.dispatchers.phantom_virtual_router.update')
-        virtual_router = IAAS.virtual_router.read(token=Token.get_instance().token, pk=virtual_router_id)
-
-        progress_state = state.RUNNING_UPDATING
-        stable_state = state.RUNNING
-        if virtual_router['state'] == state.QUIESCED_UPDATE:
-            progress_state = state.QUIESCED_UPDATING
-            stable_state = state.QUIESCED
-
-        logger.info(f'Updating phantom virtual_router #{virtual_router_id} to in progress state.')
-        response = IAAS.virtual_router.update(
-            token=Token.get_instance().token,
-            pk=virtual_router_id,
-            data={'state': progress_state},
-        )
-        if response.status_code != 200:
-            logger.error(
-                f'HTTP {response.status_code} error occurred when updating phantom virtual_router #{virtual_router_id} '
-                f'to state #{progress_state} \nResponse Text: {response.content.decode()}',
-            )
-            metrics.virtual_router_update_failure()
-        # Change the state of the virtual_router to RUNNING and report a success to influx
-        logger.info(f'Updating phantom virtual_router #{virtual_router_id} to stable state.')
-        response = IAAS.virtual_router.update(
-            token=Token.get_instance().token,
-            pk=virtual_router_id,
-            data={'state': stable_state},
-        )
-        if response.status_code != 200:
-            logger.error(
-                f'HTTP {response.status_code} error occurred when updating phantom virtual_router #{virtual_router_id} '
-                f'to state #{stable_state}\nResponse Text: {response.content.decode()}',
-            )
+        logger = PhantomVirtualRouter.loggers['update']
+        token = Token.get_instance().token
+        # Read fresh rather than through the cache, as a cached QUIESCED may be from before the virtual_router was
+        # moved to QUIESCED_UPDATE, and the update would then be skipped
+        virtual_router = utils.api_read(IAAS.virtual_router, virtual_router_id)
+        if not bool(virtual_router):
             metrics.virtual_router_update_failure()
-        else:
+            return
+        if virtual_router['state'] in (state.RUNNING, state.QUIESCED):
+            # The virtual_router is already in a stable state, ie from an earlier dispatch
+            metrics.virtual_router_update_success()
+            return
+
+        target = PhantomVirtualRouter._UPDATE_TARGETS.get(virtual_router['state'], (state.RUNNING, 'RUNNING'))
+        # Change the state of the virtual_router to its stable state and report a success to influx
+        if PhantomVirtualRouter._set_state(token, virtual_router_id, *target, logger):
             metrics.virtual_router_update_success()
+        else:
+            metrics.virtual_router_update_failure()
@@ -2,70 +2,184 @@
 mixin class containing methods that are needed by linux vm task classes
 methods included;
     - method to deploy a given command to a given host
-    - a helper method to fully retrieve the response from paramiko outputs
+    - a helper method to run a command and stream its stdout, watching for a success pattern
+    - helper methods to combine the scripts for the stages of a job into one, and split its output back out
+    - a helper method to pack a set of files into a tar archive
+    - method to upload a set of files to a given host in a single stream
 """
 # stdlib
 import logging
+import tarfile
 from collections import deque
-from time import sleep
-from typing import Deque, Tuple
+from io import BytesIO
+from time import time
+from typing import Deque, Dict, List, Optional, Pattern, Tuple
 # lib
 import opentracing
 from jaeger_client import Span
-from paramiko import Channel, SSHClient
+from paramiko import SSHClient
 # local
 
 __all__ = [
     'LinuxMixin',
 ]
 
+# Number of bytes to read from a channel at a time when streaming a command's output
+STREAM_READ_SIZE = 4096
+# Written on a line of its own, followed by the stage's name, before each stage of a script made by staged_script
+STAGE_MARKER = '---robot-stage:'
+# Size of the write buffer for files written over SFTP, just under 1MiB. It is a multiple of paramiko's largest
+# outgoing SFTP packet (30000 bytes) so the buffer is flushed in full sized packets
+SFTP_BUFFER_SIZE = 32 * 30000
+
 
 class LinuxMixin:
     logger: logging.Logger
 
-    @staticmethod
-    def get_full_response(channel: Channel, wait_time: int = 15, read_size: int = 64) -> str:
-        """
-        Get the full response from the specified paramiko channel, waiting a given number of seconds before trying to
-        read from it each time.
-        :param channel: The channel to be read from
-        :param wait_time: How long in seconds between each read
-        :param read_size: How many bytes to be read from the channel each time
-        :return: The full output from the channel, or as much as can be read given the parameters.
-        """
-        fragments: Deque[str] = deque()
-        sleep(wait_time)
-        while channel.recv_ready():
-            fragments.append(channel.recv(read_size).decode())
-            sleep(wait_time)
-        return ''.join(fragments)
-
     @classmethod
-    def deploy(cls, command: str, client: SSHClient, span: Span) -> Tuple[str, str]:
+    def _run_command(
+            cls,
+            command: str,
+            client: SSHClient,
+            span: Span,
+            success_pattern: Optional[Pattern[bytes]] = None,
+            stdin_script: Optional[str] = None,
+    ) -> Tuple[str, str, bool]:
         """
-        Deploy the given `command` to the Linux host accessible via the supplied `client`
+        Run the given `command` on the Linux host accessible via the supplied `client`, streaming its stdout.
+        If a `success_pattern` is given, each line of stdout is matched against it as it arrives, so the output doesn't
+        have to be scanned again once the command has finished.
         :param command: The command to run on the host
         :param client: A paramiko.Client instance that is connected to the host
-            The client is passed instead of the host_ip so we can avoid having to open multiple connections
         :param span: The span used for tracing the task that's currently running
-        :return: The messages retrieved from stdout and stderr of the command
+        :param success_pattern: Pattern matching the start of a line the command will write to stdout if it succeeded
+        :param stdin_script: Input to write to the command's stdin, ie a script for `bash -s` to run
+        :return: The messages retrieved from stdout and stderr of the command, and whether the pattern was matched
         """
         hostname = client.get_transport().sock.getpeername()[0]
         cls.logger.debug(f'Deploying command {command} to Linux Host {hostname}')
 
-        # Run the command via the client
+        # Run the command via the client, reading stdout as it is generated until the command closes it
         child_span = opentracing.tracer.start_span('exec_command', child_of=span)
-        _, stdout, stderr = client.exec_command(command)
+        stdin, stdout, stderr = client.exec_command(command)
+        if stdin_script is not None:
+            stdin.write(stdin_script)
+            stdin.channel.shutdown_write()
+        fragments: Deque[bytes] = deque()
+        found = False
+        # The last line of a chunk may be incomplete, so it is held back and matched once the rest of it is read
+        partial_line = b''
+        chunk = stdout.channel.recv(STREAM_READ_SIZE)
+        while chunk:
+            fragments.append(chunk)
+            if success_pattern is not None and not found:
+                lines = (partial_line + chunk).split(b'\n')
+                partial_line = lines.pop()
+                found = any(success_pattern.match(line) for line in lines)
+            chunk = stdout.channel.recv(STREAM_READ_SIZE)
+        if success_pattern is not None and not found:
+            found = success_pattern.match(partial_line) is not None
         # Block until command finishes
         stdout.channel.recv_exit_status()
+        output = b''.join(fragments).decode()
         child_span.finish()
 
-        # Read the full response from both channels
-        child_span = opentracing.tracer.start_span('read_stdout', child_of=span)
-        output = cls.get_full_response(stdout.channel)
-        child_span.finish()
-
+        # stderr is buffered by paramiko while stdout is read, so it is all there to be read once the command finishes
         child_span = opentracing.tracer.start_span('read_stderr', child_of=span)
-        error = cls.get_full_response(stderr.channel)
+        error = stderr.read().decode()
         child_span.finish()
+        return output, error, found
+
+    @classmethod
+    def deploy(
+            cls,
+            command: str,
+            client: SSHClient,
+            span: Span,
+            stdin_script: Optional[str] = None,
+    ) -> Tuple[str, str]:
+        """
+        Deploy the given `command` to the Linux host accessible via the supplied `client`
+        The command is sent in a single exec request. Any environment it needs should be set inline in the command
+        itself (ie `KEY=value command`), as each channel env request would cost another round trip to the host.
+        :param command: The command to run on the host
+        :param client: A paramiko.Client instance that is connected to the host
+            The client is passed instead of the host_ip so we can avoid having to open multiple connections
+        :param span: The span used for tracing the task that's currently running
+        :param stdin_script: Input to write to the command's stdin. Long scripts should be sent this way to `bash -s`
+            rather than as the command itself, so they aren't limited by the host's maximum command length
+        :return: The messages retrieved from stdout and stderr of the command
+        """
+        output, error, _ = cls._run_command(command, client, span, stdin_script=stdin_script)
         return output, error
+
+    @staticmethod
+    def staged_script(stages: List[Tuple[str, str]]) -> str:
+        """
+        Combine the scripts for each stage of a job into one script, so they can all be run by a single command.
+        A marker is written to both stdout and stderr before each stage, so that its output can be separated from the
+        others with `split_stages`
+        :param stages: (name, script) for each of the stages, in the order they should run
+        :return: The combined script
+        """
+        return '\n'.join(
+            f'echo "{STAGE_MARKER}{name}"\necho "{STAGE_MARKER}{name}" >&2\n{script}' for name, script in stages
+        )
+
+    @staticmethod
+    def split_stages(output: str) -> Dict[str, str]:
+        """
+        Split the output of a script made by `staged_script` into the output of each of its stages
+        :param output: The stdout or stderr of the combined script
+        :return: The output of each stage that was reached, keyed by the stage's name
+        """
+        stages: Dict[str, str] = {}
+        for section in output.split(STAGE_MARKER)[1:]:
+            name, _, stage_output = section.partition('\n')
+            stages[name] = stage_output.strip()
+        return stages
+
+    @staticmethod
+    def archive_files(files: Dict[str, str]) -> bytes:
+        """
+        Pack the given `files` into an uncompressed tar archive in memory
+        :param files: The contents of each of the files to archive, keyed by their path. Leading slashes are removed,
+            so absolute paths are extracted relative to the directory given to tar's -C option
+        :return: The bytes of the archive
+        """
+        archive = BytesIO()
+        mtime = int(time())
+        with tarfile.open(fileobj=archive, mode='w') as tar:
+            for path, content in files.items():
+                data = content.encode()
+                info = tarfile.TarInfo(path.lstrip('/'))
+                info.size = len(data)
+                info.mode = 0o644
+                info.mtime = mtime
+                tar.addfile(info, BytesIO(data))
+        return archive.getvalue()
+
+    @classmethod
+    def upload_files(cls, files: Dict[str, str], client: SSHClient, span: Span):
+        """
+        Upload the given `files` to the Linux host accessible via the supplied `client`
+        The files are packed into a single tar archive and extracted on the host by one command, rather than being
+        written one at a time over SFTP, which would cost an open, write and close round trip for every file.
+        :param files: The contents of each of the files to upload, keyed by their absolute path on the host
+        :param client: A paramiko.Client instance that is connected to the host
+        :param span: The span used for tracing the task that's currently running
+        :raises IOError: If the files could not be extracted on the host
+        """
+        archive = cls.archive_files(files)
+
+        child_span = opentracing.tracer.start_span('upload_files', child_of=span)
+        # -m so the hosts' clocks don't have to agree with ours about the archive's timestamps
+        stdin, stdout, stderr = client.exec_command('tar -xmf - -C /')
+        stdin.write(archive)
+        stdin.channel.shutdown_write()
+        exit_status = stdout.channel.recv_exit_status()
+        child_span.finish()
+        if exit_status != 0:
+            raise IOError(
+                f'Extracting {", ".join(files)} failed with exit status {exit_status}: {stderr.read().decode()}',
+            )
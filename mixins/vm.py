@@ -2,13 +2,16 @@
 mixin class containing methods that are needed by both vm task classes
 methods included;
     - a method to generate the drive information for an update
+    - methods to check for and download the image for a vm
+    - a method to remove a vm's build files from the network drive in the background
 """
 # stdlib
 import logging
 import os
 import shutil
 from collections import deque
-from typing import Any, Deque, Dict, List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Deque, Dict, List, Optional, Set, Tuple
 from urllib.error import HTTPError
 from urllib.request import urlretrieve
 # lib
@@ -20,6 +23,15 @@ __all__ = [
     'VMUpdateMixin',
 ]
 
+# Size of the write buffer for files written to the network drive. Large enough that each file is sent to the share in
+# a single write, instead of in a round trip for every default sized (8KiB) block
+NETWORK_DRIVE_BUFFER_SIZE = 128 * 1024
+
+# Shared by all of the builds for removing their files from the network drive once they are finished with them
+CLEANUP_EXECUTOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix='network-drive-cleanup')
+# Paths of the images that have been found by VMImageMixin.check_image
+_found_images: Set[str] = set()
+
 
 class VMImageMixin:
     logger: logging.Logger
@@ -32,7 +44,17 @@ class VMImageMixin:
         :param path: file location
         :return: boolean True for file exists and False for not
         """
-        return filename in os.listdir(path)
+        image_path = os.path.join(path, filename)
+        # Images are never removed while the Robot is running, so once one has been found it doesn't need checking again
+        if image_path in _found_images:
+            return True
+        # Stat the file rather than listing the whole directory, which is slow on the network mounted image stores
+        try:
+            os.stat(image_path)
+        except FileNotFoundError:
+            return False
+        _found_images.add(image_path)
+        return True
 
     @classmethod
     def download_image(cls, filename: str, path: str) -> Tuple[bool, List[str]]:
@@ -68,6 +90,23 @@ class VMImageMixin:
 
         return downloaded, errors
 
+    @classmethod
+    def remove_network_drive_files(cls, vm_id: int, path: str):
+        """
+        Remove the directory of files written to the network drive for building a VM, in the background.
+        Deleting them from the network drive takes a round trip per file and nothing needs to wait for it, so the
+        build can finish without waiting for them to be removed
+        :param vm_id: The id of the VM that was built. Used for log messages
+        :param path: Network drive location of the files
+        """
+        def _remove():
+            try:
+                shutil.rmtree(path)
+            except OSError:
+                cls.logger.warning(f'Failed to remove network drive files for VM #{vm_id}')
+
+        CLEANUP_EXECUTOR.submit(_remove)
+
 
 class VMUpdateMixin:
     logger: logging.Logger
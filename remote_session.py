@@ -0,0 +1,90 @@
+"""
+session for running commands on a linux host over a pooled ssh connection
+
+Wraps borrowing a connected client from ssh_pool and deploying commands through it, so builders don't each have to
+manage the connection themselves.
+"""
+# stdlib
+import logging
+from collections import deque
+from contextlib import ExitStack
+from typing import Deque, List, Optional, Pattern, Tuple
+# lib
+from jaeger_client import Span
+from paramiko import SSHClient
+# local
+import ssh_pool
+from mixins.linux import LinuxMixin
+
+__all__ = [
+    'RemoteSession',
+]
+
+
+class RemoteSession(LinuxMixin):
+    """
+    Context manager for running commands on a Linux host.
+    A connected client is borrowed from the pool on entry and returned to it on exit, so the socket setup, SSH
+    handshake and keepalives are all handled by ssh_pool.
+    Each command is run in its own channel, multiplexed over the borrowed client's transport.
+
+    Usage:
+        with RemoteSession(host_ip, span) as session:
+            stdout, stderr, found = session.run(commands, success_pattern=re.compile(rb'done'))
+    """
+    logger = logging.getLogger('robot.remote_session')
+
+    def __init__(self, host_ip: str, span: Span, user: str = 'administrator'):
+        """
+        :param host_ip: The ip address of the host to run commands on
+        :param span: The span used for tracing the task that's currently running
+        :param user: The user to log in to the host as
+        """
+        self.host_ip = host_ip
+        self.span = span
+        self.user = user
+        self.client: Optional[SSHClient] = None
+        self._stack = ExitStack()
+
+    def __enter__(self) -> 'RemoteSession':
+        self.client = self._stack.enter_context(ssh_pool.borrow(self.host_ip, self.user))
+        self.span.set_tag('host', self.host_ip)
+        return self
+
+    def __exit__(self, *exc_info) -> bool:
+        self.client = None
+        return self._stack.__exit__(*exc_info)
+
+    def run(
+            self,
+            commands: List[str],
+            span: Optional[Span] = None,
+            success_pattern: Optional[Pattern[bytes]] = None,
+    ) -> Tuple[str, str, bool]:
+        """
+        Run each of the given `commands`, in order, on the host
+        :param commands: The commands to run on the host
+        :param span: The span to trace the commands under, defaults to the session's span
+        :param success_pattern: Pattern matching the start of a line that one of the commands will write to stdout if
+            they succeeded
+        :return: The combined messages retrieved from stdout and stderr of all of the commands, and whether the
+            pattern was matched in the output of any of them
+        """
+        if self.client is None:
+            raise RuntimeError('RemoteSession.run can only be called inside a `with` block')
+        outputs: Deque[str] = deque()
+        errors: Deque[str] = deque()
+        found = False
+        for command in commands:
+            output, error, command_found = RemoteSession._run_command(
+                command,
+                self.client,
+                span or self.span,
+                success_pattern,
+            )
+            found = found or command_found
+            if output:
+                outputs.append(output)
+            if error:
+                errors.append(error)
+        return '\n'.join(outputs), '\n'.join(errors), found
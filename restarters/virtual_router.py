@@ -8,15 +8,16 @@ restarter class for virtual_routers
 
 # stdlib
 import logging
-import socket
 from typing import Any, Dict
 # lib
 import opentracing
 from jaeger_client import Span
-from paramiko import AutoAddPolicy, RSAKey, SSHClient, SSHException
+from paramiko import AutoAddPolicy, SSHClient, SSHException
 # local
+import ssh_pool
 import utils
 from builders import VirtualRouter as VirtualRouterBuilder
+from mixins.linux import SFTP_BUFFER_SIZE
 
 
 __all__ = [
@@ -81,12 +82,20 @@ class VirtualRouter(VirtualRouterBuilder):
             f'Generated restart bash script for virtual_router #{virtual_router_id}\n{restart_bash_script}',
         )
 
-        firewall_nft = utils.JINJA_ENV.get_template('virtual_router/features/firewall.j2').render(**template_data)
-        VirtualRouter.logger.debug(f'Generated firewall nft for virtual_router #{virtual_router_id}\n{firewall_nft}')
-
-        if len(virtual_router_data['vpns']) > 0:
-            vpn_conf = utils.JINJA_ENV.get_template('virtual_router/features/vpn.j2').render(**template_data)
-            VirtualRouter.logger.debug(f'Generated vpn conf for virtual_router #{virtual_router_id}\n{vpn_conf}')
+        # The firewall and vpn files are streamed straight from their templates into the files on the PodNet box,
+        # rather than being rendered into strings first. They are only rendered in full here when they will be logged
+        firewall_template = utils.JINJA_ENV.get_template('virtual_router/features/firewall.j2')
+        vpn_template = utils.JINJA_ENV.get_template('virtual_router/features/vpn.j2')
+        if VirtualRouter.logger.isEnabledFor(logging.DEBUG):
+            firewall_nft = firewall_template.render(**template_data)
+            VirtualRouter.logger.debug(
+                f'Generated firewall nft for virtual_router #{virtual_router_id}\n{firewall_nft}',
+            )
+            if len(virtual_router_data['vpns']) > 0:
+                vpn_conf = vpn_template.render(**template_data)
+                VirtualRouter.logger.debug(
+                    f'Generated vpn conf for virtual_router #{virtual_router_id}\n{vpn_conf}',
+                )
         child_span.finish()
 
         # Log onto PodNet box and run bash script
@@ -96,13 +105,11 @@ class VirtualRouter(VirtualRouterBuilder):
 
         client = SSHClient()
         client.set_missing_host_key_policy(AutoAddPolicy())
-        key = RSAKey.from_private_key_file('/root/.ssh/id_rsa')
-        sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+        key = ssh_pool.get_key()
         try:
             # Try connecting to the host and running the necessary commands
             # No need for password as it should have keys
-            sock.connect((management_ip, 22))
-            client.connect(hostname=management_ip, username='robot', pkey=key, timeout=30, sock=sock)
+            client.connect(hostname=management_ip, username='robot', pkey=key, timeout=30)
             span.set_tag('host', management_ip)
 
             # Firstly, Write Firewall rules file .nft and vpn.conf file(if any) to PodNet box
@@ -110,8 +117,10 @@ class VirtualRouter(VirtualRouterBuilder):
             sftp = client.open_sftp()
             firewall_filename = template_data.pop('firewall_filename')
             try:
-                with sftp.open(f'{remote_path}{firewall_filename}', mode='w', bufsize=1) as firewall:
-                    firewall.write(firewall_nft)
+                with sftp.open(f'{remote_path}{firewall_filename}', mode='w', bufsize=SFTP_BUFFER_SIZE) as firewall:
+                    # Don't wait for each write to be acknowledged, any errors are raised when the file is closed
+                    firewall.set_pipelined(True)
+                    firewall.writelines(firewall_template.generate(**template_data))
                 VirtualRouter.logger.debug(
                     f'Successfully wrote file {firewall_filename} to PodNet box#{management_ip}',
                 )
@@ -126,8 +135,10 @@ class VirtualRouter(VirtualRouterBuilder):
             if len(virtual_router_data['vpns']) > 0:
                 temp_vpn_filename = template_data.pop('temp_vpn_filename')
                 try:
-                    with sftp.open(temp_vpn_filename, mode='w', bufsize=1) as vpn:
-                        vpn.write(vpn_conf)
+                    with sftp.open(temp_vpn_filename, mode='w', bufsize=SFTP_BUFFER_SIZE) as vpn:
+                        # Don't wait for each write to be acknowledged, any errors are raised when the file is closed
+                        vpn.set_pipelined(True)
+                        vpn.writelines(vpn_template.generate(**template_data))
                     VirtualRouter.logger.debug(
                         f'Successfully wrote file {temp_vpn_filename} to PodNet box#{management_ip}')
                 except IOError as err:
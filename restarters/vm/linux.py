@@ -7,15 +7,15 @@ restarter class for linux vms
 """
 # stdlib
 import logging
-import socket
 from typing import Any, Dict, Optional
 # lib
 import opentracing
 from jaeger_client import Span
 from netaddr import IPAddress
-from paramiko import AutoAddPolicy, RSAKey, SSHClient, SSHException
+from paramiko import SSHException
 # local
 import settings
+import ssh_pool
 import utils
 from mixins import LinuxMixin
 
@@ -84,45 +84,31 @@ class Linux(LinuxMixin):
 
         Linux.logger.debug(f'Generated VM restart command for VM #{vm_id}\n{cmd}')
 
-        # Open a client and run the two necessary commands on the host
         restarted = False
-        client = SSHClient()
-        client.set_missing_host_key_policy(AutoAddPolicy())
-        key = RSAKey.from_private_key_file('/root/.ssh/id_rsa')
-        sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
         try:
-            # Try connecting to the host and running the necessary commands
-            sock.connect((host_ip, 22))
-            client.connect(
-                hostname=host_ip,
-                username='administrator',
-                pkey=key,
-                timeout=30,
-                sock=sock,
-            )  # No need for password as it should have keys
-            span.set_tag('host', host_ip)
-
-            # Attempt to execute the restart command
-            Linux.logger.debug(f'Executing restart command for VM #{vm_id}')
-
-            child_span = opentracing.tracer.start_span('restart_vm', child_of=span)
-            stdout, stderr = Linux.deploy(cmd, client, child_span)
-            child_span.finish()
-
-            if stdout:
-                Linux.logger.debug(f'VM restart command for VM #{vm_id} generated stdout.\n{stdout}')
-                restarted = True
-            if stderr:
-                error = f'VM restart command for VM #{vm_id} generated stderr.\n{stderr}.'
-                Linux.logger.error(error)
-                vm_data['errors'].append(error)
+            # Borrow a connected client for the host from the pool and run the necessary commands
+            with ssh_pool.borrow(host_ip) as client:
+                span.set_tag('host', host_ip)
+
+                # Attempt to execute the restart command
+                Linux.logger.debug(f'Executing restart command for VM #{vm_id}')
+
+                child_span = opentracing.tracer.start_span('restart_vm', child_of=span)
+                stdout, stderr = Linux.deploy(cmd, client, child_span)
+                child_span.finish()
+
+                if stdout:
+                    Linux.logger.debug(f'VM restart command for VM #{vm_id} generated stdout.\n{stdout}')
+                    restarted = True
+                if stderr:
+                    error = f'VM restart command for VM #{vm_id} generated stderr.\n{stderr}.'
+                    Linux.logger.error(error)
+                    vm_data['errors'].append(error)
         except (OSError, SSHException, TimeoutError) as err:
             error = f'Exception occurred while restarting VM #{vm_id} in {host_ip}.'
             Linux.logger.error(error, exc_info=True)
             vm_data['errors'].append(f'{error} Error: {err}')
             span.set_tag('failed_reason', 'ssh_error')
-        finally:
-            client.close()
         return restarted
 
     @staticmethod
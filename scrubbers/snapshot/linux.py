@@ -12,9 +12,10 @@ from typing import Any, Dict, Optional
 import opentracing
 from jaeger_client import Span
 from netaddr import IPAddress
-from paramiko import AutoAddPolicy, RSAKey, SSHClient, SSHException
+from paramiko import AutoAddPolicy, SSHClient, SSHException
 # local
 import settings
+import ssh_pool
 import utils
 from mixins import LinuxMixin
 
@@ -87,7 +88,7 @@ class Linux(LinuxMixin):
         scrubbed = False
         client = SSHClient()
         client.set_missing_host_key_policy(AutoAddPolicy())
-        key = RSAKey.from_private_key_file('/root/.ssh/id_rsa')
+        key = ssh_pool.get_key()
         sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
         try:
             # Try connecting to the host and running the necessary commands
@@ -8,16 +8,16 @@ scrubber class for virtual_routers
 
 # stdlib
 import logging
-import socket
 from collections import deque
 from typing import Any, Deque, Dict, Optional
 # lib
 import opentracing
 from cloudcix.api.iaas import IAAS
 from jaeger_client import Span
-from paramiko import AutoAddPolicy, RSAKey, SSHClient, SSHException
+from paramiko import AutoAddPolicy, SSHClient, SSHException
 # local
 import settings
+import ssh_pool
 import utils
 from mixins import LinuxMixin
 
@@ -96,13 +96,11 @@ class VirtualRouter(LinuxMixin):
 
         client = SSHClient()
         client.set_missing_host_key_policy(AutoAddPolicy())
-        key = RSAKey.from_private_key_file('/root/.ssh/id_rsa')
-        sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+        key = ssh_pool.get_key()
         try:
             # Try connecting to the host and running the necessary commands
             # No need for password as it should have keys
-            sock.connect((management_ip, 22))
-            client.connect(hostname=management_ip, username='robot', pkey=key, timeout=30, sock=sock)
+            client.connect(hostname=management_ip, username='robot', pkey=key, timeout=30)
             sftp = client.open_sftp()
             span.set_tag('host', management_ip)
 
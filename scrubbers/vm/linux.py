@@ -6,16 +6,16 @@ scrubber class for linux vms
 """
 # stdlib
 import logging
-import socket
 from typing import Any, Dict, Optional, Tuple
 # lib
 import opentracing
 from cloudcix.api.iaas import IAAS
 from jaeger_client import Span
 from netaddr import IPAddress
-from paramiko import AutoAddPolicy, RSAKey, SSHClient, SSHException
+from paramiko import SSHException
 # local
 import settings
+import ssh_pool
 import utils
 from mixins import LinuxMixin
 
@@ -93,57 +93,43 @@ class Linux(LinuxMixin):
         bridge_scrub_cmd, vm_scrub_cmd = Linux._generate_host_commands(vm_id, template_data)
         child_span.finish()
 
-        # Open a client and run the two necessary commands on the host
         scrubbed = False
-        client = SSHClient()
-        client.set_missing_host_key_policy(AutoAddPolicy())
-        key = RSAKey.from_private_key_file('/root/.ssh/id_rsa')
-        sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
         try:
-            # Try connecting to the host and running the necessary commands
-            sock.connect((host_ip, 22))
-            client.connect(
-                hostname=host_ip,
-                username='administrator',
-                pkey=key,
-                timeout=30,
-                sock=sock,
-            )  # No need for password as it should have keys
-            span.set_tag('host', host_ip)
-
-            # Now attempt to execute the vm scrub command
-            Linux.logger.debug(f'Executing vm scrub command for VM #{vm_id}')
-
-            child_span = opentracing.tracer.start_span('scrub_vm', child_of=span)
-            stdout, stderr = Linux.deploy(vm_scrub_cmd, client, child_span)
-            child_span.finish()
-
-            if stdout:
-                Linux.logger.debug(f'VM scrub command for VM #{vm_id} generated stdout.\n{stdout}')
-                scrubbed = True
-            if stderr:
-                Linux.logger.error(f'VM scrub command for VM #{vm_id} generated stderr.\n{stderr}')
-
-            # Check if we also need to run the command to delete the bridge
-            if delete_bridge:
-                Linux.logger.debug(f'Deleting bridge for VM #{vm_id}')
-
-                child_span = opentracing.tracer.start_span('scrub_bridge', child_of=span)
-                stdout, stderr = Linux.deploy(bridge_scrub_cmd, client, child_span)
+            # Borrow a connected client for the host from the pool and run the necessary commands
+            with ssh_pool.borrow(host_ip) as client:
+                span.set_tag('host', host_ip)
+
+                # Now attempt to execute the vm scrub command
+                Linux.logger.debug(f'Executing vm scrub command for VM #{vm_id}')
+
+                child_span = opentracing.tracer.start_span('scrub_vm', child_of=span)
+                stdout, stderr = Linux.deploy(vm_scrub_cmd, client, child_span)
                 child_span.finish()
 
                 if stdout:
-                    Linux.logger.debug(f'Bridge scrub command for VM #{vm_id} generated stdout\n{stdout}')
+                    Linux.logger.debug(f'VM scrub command for VM #{vm_id} generated stdout.\n{stdout}')
+                    scrubbed = True
                 if stderr:
-                    Linux.logger.error(f'Bridge scrub command for VM #{vm_id} generated stderr\n{stderr}')
+                    Linux.logger.error(f'VM scrub command for VM #{vm_id} generated stderr.\n{stderr}')
+
+                # Check if we also need to run the command to delete the bridge
+                if delete_bridge:
+                    Linux.logger.debug(f'Deleting bridge for VM #{vm_id}')
+
+                    child_span = opentracing.tracer.start_span('scrub_bridge', child_of=span)
+                    stdout, stderr = Linux.deploy(bridge_scrub_cmd, client, child_span)
+                    child_span.finish()
+
+                    if stdout:
+                        Linux.logger.debug(f'Bridge scrub command for VM #{vm_id} generated stdout\n{stdout}')
+                    if stderr:
+                        Linux.logger.error(f'Bridge scrub command for VM #{vm_id} generated stderr\n{stderr}')
 
         except (OSError, SSHException, TimeoutError) as err:
             error = f'Exception occurred while scrubbing VM #{vm_id} in {host_ip}.'
             Linux.logger.error(error, exc_info=True)
             vm_data['errors'].append(f'{error} Error: {err}')
             span.set_tag('failed_reason', 'ssh_error')
-        finally:
-            client.close()
         return scrubbed
 
     @staticmethod
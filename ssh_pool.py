@@ -0,0 +1,236 @@
+"""
+pool of authenticated paramiko clients that can be reused between jobs on the same host
+
+Clients are kept per (host_ip, username) pair and are put back into the pool when a job is finished with them,
+instead of being closed, so consecutive jobs on a host do not have to repeat the TCP connect, SSH handshake and key
+exchange.
+The pool is thread safe, each borrowed client is only ever used by one job at a time.
+"""
+# stdlib
+import atexit
+import fcntl
+import logging
+import os
+import socket
+from contextlib import contextmanager
+from functools import lru_cache
+from queue import Empty, Queue
+from threading import Lock
+from typing import Any, Dict, Iterator, Optional, Tuple
+# lib
+from paramiko import HostKeys, MissingHostKeyPolicy, PKey, RSAKey, SSHClient, SSHException
+# local
+
+__all__ = [
+    'borrow',
+    'get_key',
+]
+
+# Location of the private key used to log in to the hosts
+KEY_FILE = '/root/.ssh/id_rsa'
+# Location of the known_hosts file that the hosts' keys are verified against
+KNOWN_HOSTS_FILE = '/root/.ssh/known_hosts'
+# Seconds to wait for the TCP connection to a host to be established, so an unreachable host fails fast instead of
+# waiting on the operating system's connect timeout
+CONNECT_TIMEOUT = 10
+# Interval in seconds between keepalive packets, to stop idle pooled connections being dropped by NAT / firewalls
+KEEPALIVE_INTERVAL = 30
+# Legacy algorithms that are never negotiated with the hosts, so the handshake settles on curve25519 key exchange,
+# ed25519 / ecdsa host keys and AES ciphers without considering the slower options
+DISABLED_ALGORITHMS = {
+    'kex': [
+        'diffie-hellman-group1-sha1',
+        'diffie-hellman-group14-sha1',
+        'diffie-hellman-group-exchange-sha1',
+        'diffie-hellman-group-exchange-sha256',
+    ],
+    'ciphers': ['3des-cbc', 'aes128-cbc', 'aes192-cbc', 'aes256-cbc', 'blowfish-cbc'],
+    'macs': ['hmac-md5', 'hmac-md5-96', 'hmac-sha1-96'],
+    'keys': ['ssh-dss'],
+}
+
+# Load the key once on import instead of once per connection. If the file isn't present (ie when the module is
+# imported outside of a Robot container), it will be loaded when the first connection is made instead.
+try:
+    _key: Optional[PKey] = RSAKey.from_private_key_file(KEY_FILE)
+except (OSError, SSHException):
+    _key = None
+
+# Parse the known hosts once on import, they are shared between all of the connections in the pool
+_known_hosts = HostKeys()
+if os.path.exists(KNOWN_HOSTS_FILE):
+    _known_hosts.load(KNOWN_HOSTS_FILE)
+_known_hosts_lock = Lock()
+
+_pool: Dict[Tuple[str, str], Queue] = {}
+_pool_lock = Lock()
+logger = logging.getLogger('robot.ssh_pool')
+
+
+def get_key() -> PKey:
+    """
+    Retrieve the private key used for logging in to the hosts, loading it if it wasn't available on import
+    """
+    global _key
+    if _key is None:
+        _key = RSAKey.from_private_key_file(KEY_FILE)
+    return _key
+
+
+def _pin_host_key(hostname: str, key: PKey):
+    """
+    Record the key presented by a host that has never been connected to before in the known_hosts file.
+    This is trust on first use: nothing verifies the first key a host presents, the same as the AutoAddPolicy the
+    builders used before, but once it is recorded any other key presented by the host is rejected.
+    _known_hosts_lock only covers the threads of this process, so the file itself is locked while it is checked and
+    appended to, stopping several celery workers from each recording the same host
+    """
+    with open(KNOWN_HOSTS_FILE, 'a+') as known_hosts:
+        fcntl.flock(known_hosts, fcntl.LOCK_EX)
+        # Another process may have recorded the host while this one was waiting for the lock
+        _known_hosts.load(KNOWN_HOSTS_FILE)
+        if _known_hosts.lookup(hostname) is not None:
+            return
+        logger.warning(
+            f'Host {hostname} is not in {KNOWN_HOSTS_FILE}, trusting the unverified {key.get_name()} key it presented',
+        )
+        known_hosts.write(f'{hostname} {key.get_name()} {key.get_base64()}\n')
+        known_hosts.flush()
+    _known_hosts.add(hostname, key.get_name(), key)
+
+
+class _KnownHostsPolicy(MissingHostKeyPolicy):
+    """
+    Handle hosts that aren't in the shared known hosts yet. Known hosts have their keys copied into each client before
+    it connects, so paramiko checks them itself and this is only called on first contact, when the key the host
+    presents is pinned without being verified (see _pin_host_key), or if a known host presents a key of another type,
+    which is rejected.
+    """
+
+    def missing_host_key(self, client: SSHClient, hostname: str, key: PKey):
+        with _known_hosts_lock:
+            if _known_hosts.lookup(hostname) is None:
+                _pin_host_key(hostname, key)
+            if not _known_hosts.check(hostname, key):
+                raise SSHException(f'Server {hostname} presented a key that does not match {KNOWN_HOSTS_FILE}')
+
+
+@lru_cache(maxsize=512)
+def _addr_of(host_ip: str, port: int = 22) -> Tuple[socket.AddressFamily, Tuple[Any, ...]]:
+    """
+    Convert a literal IPv4 or IPv6 address into the address family and sockaddr to connect to.
+    AI_NUMERICHOST stops getaddrinfo consulting the name services, and the result is cached for reconnects
+    """
+    family, _, _, _, sockaddr = socket.getaddrinfo(
+        host_ip,
+        port,
+        socket.AF_UNSPEC,
+        socket.SOCK_STREAM,
+        0,
+        socket.AI_NUMERICHOST,
+    )[0]
+    return family, sockaddr
+
+
+def _get_queue(host_ip: str, user: str) -> Queue:
+    """
+    Get the queue of idle clients for the given host and user, creating it if necessary
+    """
+    with _pool_lock:
+        return _pool.setdefault((host_ip, user), Queue())
+
+
+def _is_active(client: SSHClient) -> bool:
+    """
+    Check whether the connection underlying the given client is still usable
+    """
+    transport = client.get_transport()
+    return transport is not None and transport.is_active()
+
+
+def _connect(host_ip: str, user: str, key: PKey) -> SSHClient:
+    """
+    Open a new connection to the specified host
+    """
+    logger.debug(f'Opening new SSH connection to {user}@{host_ip}')
+    client = SSHClient()
+    # Give the client the keys already known for the host, so paramiko verifies them itself and asks the host for
+    # the type of key that is recorded rather than one that would then have to be checked against the others
+    client_host_keys = client.get_host_keys()
+    with _known_hosts_lock:
+        for key_type, host_key in (_known_hosts.lookup(host_ip) or {}).items():
+            client_host_keys.add(host_ip, key_type, host_key)
+    client.set_missing_host_key_policy(_KnownHostsPolicy())
+    family, sockaddr = _addr_of(host_ip)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    # Disable Nagle's algorithm so the many small packets of the SSH handshake aren't delayed
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    sock.settimeout(CONNECT_TIMEOUT)
+    try:
+        sock.connect(sockaddr)
+        client.connect(
+            hostname=host_ip,
+            username=user,
+            pkey=key,
+            timeout=30,
+            sock=sock,
+            disabled_algorithms=DISABLED_ALGORITHMS,
+        )  # No need for password as it should have keys
+    except BaseException:
+        client.close()
+        sock.close()
+        raise
+    client.get_transport().set_keepalive(KEEPALIVE_INTERVAL)
+    return client
+
+
+@contextmanager
+def borrow(host_ip: str, user: str = 'administrator', key: Optional[PKey] = None) -> Iterator[SSHClient]:
+    """
+    Borrow a connected client for the given host from the pool, opening a new connection if there are no live idle
+    clients available.
+    The client is returned to the pool when the block exits cleanly, and closed if an exception occurs within it.
+    :param host_ip: The ip address of the host to connect to
+    :param user: The user to log in to the host as
+    :param key: The private key to log in with, defaults to the Robot's key
+    :return: A paramiko.SSHClient instance that is connected to the host
+    """
+    idle = _get_queue(host_ip, user)
+    client: Optional[SSHClient] = None
+    while client is None:
+        try:
+            client = idle.get_nowait()
+        except Empty:
+            break
+        if not _is_active(client):
+            # The connection has been dropped since it was last used, discard it and try the next one
+            client.close()
+            client = None
+    if client is None:
+        client = _connect(host_ip, user, key or get_key())
+
+    try:
+        yield client
+    except BaseException:
+        client.close()
+        raise
+    if _is_active(client):
+        idle.put(client)
+    else:
+        client.close()
+
+
+@atexit.register
+def _close_all():
+    """
+    Close all of the idle pooled connections when the process exits
+    """
+    with _pool_lock:
+        queues = list(_pool.values())
+    for idle in queues:
+        while True:
+            try:
+                idle.get_nowait().close()
+            except Empty:
+                break
@@ -207,9 +207,10 @@ def _build_vm(vm_id: int, span: Span):
 
         # Calculate the total time it took to build the VM entirely
         # uctnow - vm created time
-        total_time = datetime.utcnow() - datetime.strptime(vm['created'], '%Y-%m-%dT%H:%M:%S.%f')
-        logger.debug(f'Finished building VM #{vm_id} in {total_time.seconds} seconds')
-        metrics.vm_build_success(total_time.seconds)
+        # total_seconds, as timedelta.seconds leaves out any whole days
+        total_time = int((datetime.utcnow() - datetime.strptime(vm['created'], '%Y-%m-%dT%H:%M:%S.%f')).total_seconds())
+        logger.debug(f'Finished building VM #{vm_id} in {total_time} seconds')
+        metrics.vm_build_success(total_time)
     else:
         logger.error(f'Failed to build VM #{vm_id}')
         vm.pop('admin_password', None)
@@ -7,11 +7,14 @@ import logging
 import os
 import subprocess
 from collections import deque
+from contextlib import contextmanager
 from json import JSONEncoder
-from typing import Any, Deque, Dict, Iterable, Optional, Tuple
+from typing import Any, Deque, Dict, Iterable, Iterator, Optional, Tuple
 # lib
 import jinja2
 import netaddr
+import opentracing
+from jaeger_client import Span
 from logstash_async.formatter import LogstashFormatter
 from logstash_async.handler import AsynchronousLogstashHandler
 # local
@@ -28,19 +31,46 @@ from settings import (
 __all__ = [
     'api_list',
     'api_read',
+    'find_ipv6_interface',
     'flush_logstash',
     'get_current_git_sha',
     'JINJA_ENV',
+    'preload_templates',
     'setup_root_logger',
+    'traced',
     'write_to_drive',
 ]
 
 JINJA_ENV = jinja2.Environment(
     loader=jinja2.FileSystemLoader('templates'),
     trim_blocks=True,
+    # Strip the indentation before block tags too, so indented tags don't leave stray whitespace in the rendered output
+    lstrip_blocks=True,
+    # Templates only change on deploy, so don't stat the files on every lookup, and never evict compiled templates
+    auto_reload=False,
+    cache_size=-1,
+    # Compiled templates are kept on disk so new worker processes don't have to compile them from scratch. No directory
+    # is given, so jinja uses its own per user cache directory, which it creates with 0700 permissions and checks the
+    # ownership of before loading any bytecode from it
+    bytecode_cache=jinja2.FileSystemBytecodeCache(),
 )
 
 
+def preload_templates(*names: str):
+    """
+    Compile the named templates into JINJA_ENV's cache, so the first job to use each of them doesn't have to.
+    Called once by each module for the templates it renders, which then just look them up with
+    `JINJA_ENV.get_template`. Templates that can't be found (ie when not run from the Robot's root directory) are
+    skipped, and reported when they are next looked up
+    :param names: The names of the templates to compile
+    """
+    for name in names:
+        try:
+            JINJA_ENV.get_template(name)
+        except jinja2.TemplateNotFound:
+            pass
+
+
 class DequeEncoder(JSONEncoder):
     """
     JSON Encoder that will allow us to encode deques without changing too much in the code
@@ -121,6 +151,26 @@ def flush_logstash():
             handler.flush()
 
 
+@contextmanager
+def traced(parent_span: Span, name: str) -> Iterator[Span]:
+    """
+    Trace the enclosed block in a new child span of `parent_span`, finishing it when the block exits.
+    If the trace isn't being sampled no child span is created, as it would never be reported, and `parent_span` is
+    yielded in its place.
+    :param parent_span: The span of the task that's currently running
+    :param name: The operation name of the child span
+    :returns: The span to use within the block
+    """
+    if not parent_span.is_sampled():
+        yield parent_span
+        return
+    child_span = opentracing.tracer.start_span(name, child_of=parent_span)
+    try:
+        yield child_span
+    finally:
+        child_span.finish()
+
+
 # Methods that wrap cloudcix clients to abstract retrieval and checking
 # These methods replace the ones in ro.py
 # However, we only replace the list and read method, since wrapping update and delete didn't really affect the code
@@ -225,6 +275,20 @@ def api_read(client: Client, pk: int, **kwargs) -> Dict[str, Any]:
     return obj
 
 
+def find_ipv6_interface(interfaces: Iterable[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """
+    Find the first enabled interface of a server that has an IPv6 address, which is the one used to reach the server
+    :param interfaces: The interfaces of the server, as read from the API
+    :returns: The interface, or None if the server has none
+    """
+    for interface in interfaces:
+        ip_address = interface['ip_address']
+        # IPv6 addresses are the only ones that contain colons, so there's no need to parse each address
+        if interface['enabled'] is True and ip_address is not None and ':' in ip_address:
+            return interface
+    return None
+
+
 def write_to_drive(
     conf: str,
     filename: str,